@@ -0,0 +1,53 @@
+import asyncio
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+import profiling
+from config import ADMIN_TOKEN, SAMPLER_MAX_RATE, SAMPLER_MAX_SECONDS
+from sampler import sample_stacks
+
+
+def verify_admin_token(x_admin_token: Optional[str]=Header(None)):
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+
+_admin_router = APIRouter(dependencies=[Depends(verify_admin_token)])
+
+# one sampling profile at a time per worker
+_sampling_lock = asyncio.Lock()
+
+
+@_admin_router.get('/profiling')
+async def get_profiling():
+    return profiling.settings()
+
+
+@_admin_router.put('/profiling')
+async def set_profiling(
+        enabled: bool,
+        max_queries: Optional[int]=Query(None, ge=0),
+        slow_ms: Optional[float]=Query(None, ge=0),
+):
+    """Switch per-request profiling and its logging thresholds, in this worker process."""
+    profiling.configure(enabled, max_queries, slow_ms)
+    return profiling.settings()
+
+
+@_admin_router.get('/profile', response_class=PlainTextResponse)
+async def get_profile(
+        seconds: float=Query(10, gt=0, le=SAMPLER_MAX_SECONDS),
+        rate: float=Query(100, gt=0, le=SAMPLER_MAX_RATE),
+):
+    """Sample the stacks of all threads of this worker, returned as collapsed stacks for flamegraph tools."""
+    if _sampling_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already being taken.")
+    async with _sampling_lock:
+        # in its own thread, so the event loop keeps running and shows up in the samples
+        trie = await asyncio.to_thread(sample_stacks, seconds, rate)
+    return PlainTextResponse(trie.collapsed(), headers={'X-Samples': str(trie.samples)})
@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+
+from config import DB_MAX_OVERFLOW
+from database.db import engine
+
+_health_router = APIRouter()
+
+
+@_health_router.get('/db')
+async def get_db_pool_status():
+    pool = engine.pool
+    return {
+        'pool_size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'idle': pool.checkedin(),
+        # negative while the pool itself is not full yet
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': DB_MAX_OVERFLOW,
+    }
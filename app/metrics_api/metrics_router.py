@@ -0,0 +1,10 @@
+from fastapi import APIRouter, Response
+
+from metrics import render_metrics
+
+_metrics_router = APIRouter()
+
+
+@_metrics_router.get('')
+async def get_metrics():
+    return Response(render_metrics(), media_type='text/plain; version=0.0.4; charset=utf-8')
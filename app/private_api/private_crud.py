@@ -1,55 +1,383 @@
-from typing import Optional
+import asyncio
+import logging
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional
 
 from fastapi import HTTPException, UploadFile
-from sqlalchemy import delete
+from sqlalchemy import (Integer, String, any_, bindparam, column, delete, desc,
+                        func, or_, update, values)
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
-from database.models import Meme, User
-from minio_server import (delete_image_from_minio, update_image_in_minio,
-                          upload_image_to_minio)
+from config import BATCH_UPLOAD_CONCURRENCY
+from database.models import ImageObject, Meme
+from database.schemas import BatchItemStatus, CurrentUser
+from image_variants import schedule_variants
+from response_cache import response_cache
+from storage import (StagedImage, delete_images, discard_staged_images,
+                     image_object_name, image_url_for, promote_image,
+                     upload_image)
+from utils import (bump_table_version, cursor_int, pack_cursor, unpack_cursor,
+                   validate_image)
 
+logger = logging.getLogger(__name__)
 
-async def update_meme_data(db: AsyncSession, meme_id: Optional[int], description: Optional[str]=None, file: UploadFile=None):
+
+async def _gather_all(awaitables) -> list:
+    """Wait for all of them to finish, then raise the first failure, so the cleanup never races a task."""
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def store_staged_images(db: AsyncSession, staged_images: List[StagedImage]) -> List[str]:
+    """
+    Store the content of each upload, then take a reference on it in one statement.
+    Identical bytes are stored once, under their SHA-256. The object exists before
+    its reference does, so a returned URL never points at nothing.
+    """
+    counts = Counter(staged.digest for staged in staged_images)
+    sizes = {staged.digest: staged.size for staged in staged_images}
+    # one upload of each content is promoted, the others are only discarded
+    unique = {staged.digest: staged for staged in staged_images}
+
+    statement = insert(ImageObject).values(
+        [{'key': digest, 'size': sizes[digest], 'ref_count': count} for digest, count in counts.items()]
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[ImageObject.key],
+        set_={'ref_count': ImageObject.ref_count + statement.excluded.ref_count, 'referenced_at': func.now()},
+    ).returning(ImageObject.key, ImageObject.ref_count)
+    try:
+        await _gather_all(promote_image(staged) for staged in unique.values())
+        async with db.begin():
+            ref_counts = dict((await db.execute(statement)).all())
+    except BaseException:
+        # promoted objects left without a reference are removed by the reconcile job
+        await discard_staged_images(staged_images)
+        raise
+
+    image_urls = [image_url_for(staged.digest) for staged in staged_images]
+    # a new row: the last release of this content may have deleted the object between
+    # the promotion and the insert, the insert waited for it, so it is checked again
+    new_images = [staged for digest, staged in unique.items() if ref_counts[digest] == counts[digest]]
+    try:
+        await _gather_all(promote_image(staged) for staged in new_images)
+    except BaseException:
+        await release_images(db, image_urls)
+        raise
+    finally:
+        await discard_staged_images(staged_images)
+
+    for staged in new_images:
+        schedule_variants(image_url_for(staged.digest))
+    return image_urls
+
+
+async def store_image(db: AsyncSession, file: UploadFile) -> str:
+    """Upload the image and take a reference on its content."""
+    staged = await upload_image(file)
+    image_urls = await store_staged_images(db, [staged])
+    return image_urls[0]
+
+
+async def release_images(db: AsyncSession, image_urls: List[str]):
+    """
+    Drop a reference on each image, the objects are deleted with the last one.
+    All references are released in one statement, whatever the number of images.
+    """
+    counts = Counter(image_object_name(image_url) for image_url in image_urls)
+    urls = {image_object_name(image_url): image_url for image_url in image_urls}
+
+    released = values(column('key', String), column('count', Integer), name='released').data(list(counts.items()))
+    async with db.begin():
+        # a real transaction, unlike the engine's autocommit: the deleted rows stay locked
+        # until their objects are gone, so an upload of the same bytes waits and stores them
+        # again; a failed delete rolls back and keeps the references
+        await db.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+        result = await db.execute(
+            update(ImageObject)
+            .where(ImageObject.key == released.c.key)
+            .values(ref_count=ImageObject.ref_count - released.c.count)
+            .returning(ImageObject.key, ImageObject.ref_count)
+            .execution_options(synchronize_session=False)
+        )
+        ref_counts = dict(result.all())
+        # no row: an image uploaded before deduplication, owned by this meme alone
+        last_references = [key for key in counts if key not in ref_counts]
+        unreferenced = [key for key, ref_count in ref_counts.items() if ref_count <= 0]
+        if unreferenced:
+            # skipped when a concurrent upload took a new reference meanwhile, or when a meme
+            # still uses the image: the count was repaired by the reconcile job between the
+            # delete of a meme and the release of its image
+            still_used = select(Meme.id).where(Meme.image_url == func.concat(image_url_for(''), ImageObject.key)).exists()
+            result = await db.execute(
+                delete(ImageObject)
+                .where(ImageObject.key.in_(unreferenced), ImageObject.ref_count <= 0, ~still_used)
+                .returning(ImageObject.key)
+                .execution_options(synchronize_session=False)
+            )
+            last_references += result.scalars().all()
+
+        if last_references:
+            await delete_images([urls[key] for key in last_references])
+
+
+async def release_image(db: AsyncSession, image_url: str):
+    """Drop a reference on the image, the object is deleted with the last one."""
+    await release_images(db, [image_url])
+
+
+async def update_meme_data(db: AsyncSession, meme_id: Optional[int], user_id: uuid.UUID, description: Optional[str]=None, file: UploadFile=None) -> bool:
+    """
+    Update the meme with a single ownership-checked statement.
+    Returns False when there is no meme with this id belonging to the user.
+    """
+    new_image_url = await store_image(db, file) if file else None
+
+    values = {}
+    if description:
+        values['description'] = description
+    if new_image_url:
+        values['image_url'] = new_image_url
+    if not values:
+        # nothing to change, the statement still checks the ownership
+        values['description'] = Meme.description
+
+    # the previous image is read from the locked row: a concurrent update either
+    # waits for this one or has already committed, so each old image is released once
+    old_meme = (
+        select(Meme.id, Meme.image_url)
+        .where(Meme.id == meme_id, Meme.user_id == user_id)
+        .with_for_update()
+        .cte('old_meme')
+    )
+
+    statement = (
+        update(Meme)
+        .where(Meme.id == old_meme.c.id)
+        .values(**values)
+        .returning(old_meme.c.image_url)
+        .execution_options(synchronize_session=False)
+    )
     async with db.begin():
-        meme = await db.get(Meme, meme_id)
-       
-        if description:
-            meme.description = description
+        result = await db.execute(statement)
+        row = result.first()
+        if row is not None:
+            await bump_table_version(db, Meme.__tablename__)
 
-        if file:
-            new_image_url = await update_image_in_minio(file, meme.image_url)
-            meme.image_url = new_image_url
+    if row is None:
+        if new_image_url:
+            await release_image(db, new_image_url)
+        return False
 
-        await db.flush()
+    await response_cache.invalidate(Meme.__tablename__)
+    if new_image_url:
+        await release_image(db, row[0])
+    return True
 
 
-async def save_meme(db: AsyncSession,  meme_id: Optional[int]=None, description: Optional[str]=None, file: UploadFile=None, author: User=None):
+async def save_meme(db: AsyncSession,  meme_id: Optional[int]=None, description: Optional[str]=None, file: UploadFile=None, author: CurrentUser=None) -> bool:
     try:
         if meme_id:
-            await update_meme_data(db, meme_id, description, file)
-        else:
+            return await update_meme_data(db, meme_id, author.id, description, file)
+
+        image_url = await store_image(db, file)
+        try:
             async with db.begin():
-                image_url = await upload_image_to_minio(file)
-                meme = Meme(description=description, image_url=image_url, author=author)
+                meme = Meme(description=description, image_url=image_url, user_id=author.id)
                 db.add(meme)
                 await db.flush()
+                await bump_table_version(db, Meme.__tablename__)
+        except Exception:
+            await release_image(db, image_url)
+            raise
+
+        await response_cache.invalidate(Meme.__tablename__)
+        return True
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save meme: {e}")
 
 
-async def delete_meme_in_db(db: AsyncSession,  meme_id: Optional[int], image_url: Optional[str]):
-   
+async def save_memes_batch(db: AsyncSession, files: List[UploadFile], descriptions: List[str], author: CurrentUser) -> List[BatchItemStatus]:
+    """
+    Upload the images concurrently, then insert all memes in one statement.
+    Returns the status of every file, in the order they were sent.
+    """
+    items = [BatchItemStatus(index=index, filename=file.filename, status='ok') for index, file in enumerate(files)]
+    semaphore = asyncio.Semaphore(BATCH_UPLOAD_CONCURRENCY)
+
+    async def upload(file: UploadFile) -> StagedImage:
+        async with semaphore:
+            return await upload_image(validate_image(file))
+
+    uploads = await asyncio.gather(*[upload(file) for file in files], return_exceptions=True)
+
+    uploaded = []
+    for item, result in zip(items, uploads):
+        if isinstance(result, Exception):
+            item.status, item.detail = 'error', str(result)
+        else:
+            uploaded.append((item, result))
+
+    if not uploaded:
+        return items
+
+    image_urls = await store_staged_images(db, [staged for _, staged in uploaded])
+    rows = [
+        {
+            'description': descriptions[item.index] if item.index < len(descriptions) else None,
+            'image_url': image_url,
+            'user_id': author.id,
+        }
+        for (item, _), image_url in zip(uploaded, image_urls)
+    ]
+
+    try:
+        async with db.begin():
+            result = await db.execute(insert(Meme).returning(Meme.id, sort_by_parameter_order=True), rows)
+            meme_ids = result.scalars().all()
+            await bump_table_version(db, Meme.__tablename__)
+    except Exception:
+        await release_images(db, image_urls)
+        raise
+
+    await response_cache.invalidate(Meme.__tablename__)
+    for (item, _), meme_id in zip(uploaded, meme_ids):
+        item.id = meme_id
+    return items
+
+
+async def delete_meme_in_db(db: AsyncSession,  meme_id: Optional[int], user_id: uuid.UUID) -> bool:
+    """
+    Delete the meme with a single ownership-checked statement, then its image.
+    Returns False when there is no meme with this id belonging to the user.
+    """
+    statement = (
+        delete(Meme)
+        .where(Meme.id == meme_id, Meme.user_id == user_id)
+        .returning(Meme.image_url)
+        .execution_options(synchronize_session=False)
+    )
+    async with db.begin():
+        result = await db.execute(statement)
+        row = result.first()
+        if row is not None:
+            await bump_table_version(db, Meme.__tablename__)
+
+    if row is None:
+        return False
+
+    await response_cache.invalidate(Meme.__tablename__)
+    await release_image(db, row[0])
+    return True
+
+
+async def delete_memes_batch(db: AsyncSession, meme_ids: List[int], user_id: uuid.UUID) -> List[BatchItemStatus]:
+    """
+    Delete the user's memes with a single ownership-checked statement, then their images.
+    Returns the status of every requested id: deleted, forbidden or not_found.
+    The deletes are committed before the store is called, a failed release is
+    reported on the deleted items and its images are left to the reconcile job.
+    """
+    meme_ids = list(dict.fromkeys(meme_ids))
+    # one array parameter keeps the statement identical whatever the number of ids
+    ids = bindparam('ids', meme_ids, type_=ARRAY(Integer))
+
+    statement = (
+        delete(Meme)
+        .where(Meme.id == any_(ids), Meme.user_id == user_id)
+        .returning(Meme.id, Meme.image_url)
+        .execution_options(synchronize_session=False)
+    )
+    async with db.begin():
+        result = await db.execute(statement)
+        deleted = dict(result.all())
+        if deleted:
+            await bump_table_version(db, Meme.__tablename__)
+
+    existing = set()
+    missing = [meme_id for meme_id in meme_ids if meme_id not in deleted]
+    if missing:
+        # the owner lookup is only paid for the ids that were not deleted
+        async with db.begin():
+            result = await db.execute(
+                select(Meme.id).where(Meme.id == any_(bindparam('ids', missing, type_=ARRAY(Integer))))
+            )
+            existing = set(result.scalars().all())
+
+    release_error = None
+    if deleted:
+        await response_cache.invalidate(Meme.__tablename__)
+        try:
+            await release_images(db, list(deleted.values()))
+        except Exception as err:
+            logger.warning("Failed to release the images of memes %s: %s", list(deleted), err)
+            release_error = f"Image not deleted yet: {err}"
+
+    items = []
+    for index, meme_id in enumerate(meme_ids):
+        if meme_id in deleted:
+            items.append(BatchItemStatus(index=index, id=meme_id, status='deleted', detail=release_error))
+        elif meme_id in existing:
+            items.append(BatchItemStatus(index=index, id=meme_id, status='forbidden', detail="Only the author can delete this meme."))
+        else:
+            items.append(BatchItemStatus(index=index, id=meme_id, status='not_found', detail=f"Meme number {meme_id} does not exist."))
+    return items
+
+
+def encode_user_memes_cursor(meme: Meme) -> str:
+    """Cursor pointing right after the given meme in the author's listing."""
+    return pack_cursor({'s': 'mine', 'k': [meme.created_at.isoformat(), meme.id]})
+
+
+def decode_user_memes_cursor(cursor: str) -> list:
+    payload = unpack_cursor(cursor)
+    if payload.get('s') != 'mine':
+        raise HTTPException(status_code=400, detail='Cursor does not match the requested sorting')
+
+    try:
+        created_at, meme_id = payload['k']
+        return [datetime.fromisoformat(created_at), cursor_int(meme_id)]
+    except (ValueError, TypeError, OverflowError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+async def get_user_memes(db: AsyncSession, user_id: uuid.UUID, size: int, cursor: Optional[str]=None) -> List[Meme]:
+    """The author's memes, newest first, in the order of ix_memes_user_id_created_at_id."""
+    query = (
+        select(Meme)
+        .where(Meme.user_id == user_id)
+        .order_by(desc(Meme.created_at), Meme.id)
+        .limit(size)
+    )
+    if cursor:
+        last_created_at, last_id = decode_user_memes_cursor(cursor)
+        # the two columns go in opposite directions, so no row comparison here;
+        # the separate bound on created_at lets the index scan start at the cursor
+        query = query.where(
+            Meme.created_at <= last_created_at,
+            or_(Meme.created_at < last_created_at, Meme.id > last_id),
+        )
+
     async with db.begin():
+        result = await db.execute(query)
+        return result.scalars().all()
+
 
-        exists_statement = delete(Meme).where(
-            (Meme.id == meme_id)
+async def get_meme_owner(db: AsyncSession, meme_id: int) -> Optional[uuid.UUID]:
+    async with db.begin():
+        result = await db.execute(
+            select(Meme.user_id).where(Meme.id == meme_id)
         )
-        await db.execute(exists_statement)
-        await db.commit()
+        return result.scalar()
 
-    await delete_image_from_minio(image_url)  
 
 async def get_meme_from_db(db: AsyncSession, meme_id: int):
     async with db.begin():
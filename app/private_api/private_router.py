@@ -1,23 +1,49 @@
-from fastapi import (APIRouter, Depends, File, HTTPException, Response,
-                     UploadFile)
-from minio.error import S3Error
+from email.utils import format_datetime
+from typing import List, Optional
+
+from fastapi import (APIRouter, Depends, File, Form, HTTPException, Query,
+                     Request, Response, UploadFile)
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.public_api.public_crud import get_current_user_from_token
+from config import BATCH_DELETE_MAX_IDS, BATCH_UPLOAD_MAX_FILES, IMAGE_DELIVERY
 from database.db import get_db
-from database.models import User
-from database.schemas import LoadingMeme, ShowMemesPrivate, StatusResponse
-from minio_server import minio_client
-from utils import validate_image
-
-from .private_crud import delete_meme_in_db, get_meme_from_db, save_meme
+from database.schemas import (BatchDeleteRequest, BatchItemStatus,
+                              BatchStatusResponse, CurrentUser, LoadingMeme,
+                              ShowMemesPrivate, StatusResponse)
+from image_variants import nearest_variant
+from storage import (image_file_path, presigned_image_url, stat_image,
+                     stream_image)
+from utils import if_range_matches, parse_range_header, validate_image
+
+from .private_crud import (delete_meme_in_db, delete_memes_batch,
+                           encode_user_memes_cursor, get_meme_from_db,
+                           get_meme_owner, get_user_memes, save_meme,
+                           save_memes_batch)
 
 _private_router = APIRouter()
 
+memes_private_adapter = TypeAdapter(list[ShowMemesPrivate])
+
+
+async def meme_not_available(db: AsyncSession, meme_id: int, action: str) -> HTTPException:
+    """Error for a write that matched no row: the meme is either missing or someone else's."""
+    if await get_meme_owner(db, meme_id) is None:
+        return HTTPException(status_code=404, detail=f"Meme number {meme_id} does not exist.")
+    return HTTPException(status_code=404, detail=f"Only the author can {action} this meme.")
+
+
+def batch_response(items: List[BatchItemStatus], success: str) -> BatchStatusResponse:
+    failed = sum(item.status != success for item in items)
+    status = 'ok' if not failed else 'error' if failed == len(items) else 'partial'
+    return BatchStatusResponse(status=status, items=items)
+
 
 @_private_router.post('/', response_model=StatusResponse)
 async def upload_meme(file: UploadFile, description: str=None, 
-                       db: AsyncSession=Depends(get_db),  author: User=Depends(get_current_user_from_token)):
+                       db: AsyncSession=Depends(get_db),  author: CurrentUser=Depends(get_current_user_from_token)):
     try:
         file = validate_image(file)
         await save_meme(db, description=description, file=file, author=author)
@@ -28,8 +54,55 @@ async def upload_meme(file: UploadFile, description: str=None,
     return StatusResponse(status="ok", message="Meme uploaded successfully")
 
 
+@_private_router.post('/batch', response_model=BatchStatusResponse)
+async def upload_memes_batch(files: List[UploadFile]=File(...), descriptions: List[str]=Form(None),
+                             db: AsyncSession=Depends(get_db), author: CurrentUser=Depends(get_current_user_from_token)):
+    if len(files) > BATCH_UPLOAD_MAX_FILES:
+        raise HTTPException(status_code=422, detail=f"No more than {BATCH_UPLOAD_MAX_FILES} files per request.")
+
+    try:
+        items = await save_memes_batch(db, files, descriptions or [], author)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to upload images: {e}")
+
+    return batch_response(items, 'ok')
+
+
+@_private_router.post('/batch-delete', response_model=BatchStatusResponse)
+async def delete_memes(request: BatchDeleteRequest, db: AsyncSession=Depends(get_db), author: CurrentUser=Depends(get_current_user_from_token)):
+    if len(request.ids) > BATCH_DELETE_MAX_IDS:
+        raise HTTPException(status_code=422, detail=f"No more than {BATCH_DELETE_MAX_IDS} ids per request.")
+
+    try:
+        items = await delete_memes_batch(db, request.ids, author.id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete memes: {e}")
+
+    return batch_response(items, 'deleted')
+
+
+@_private_router.get('/mine', response_model=list[ShowMemesPrivate])
+async def get_my_memes(
+    size: int=Query(10, ge=1, le=100, description="Количество записей на странице"),
+    cursor: Optional[str]=Query(None, description='Курсор следующей страницы (заголовок X-Next-Cursor)'),
+    db: AsyncSession=Depends(get_db), author: CurrentUser=Depends(get_current_user_from_token)
+) -> list[ShowMemesPrivate]:
+    memes = await get_user_memes(db, author.id, size=size, cursor=cursor)
+    if not memes:
+        raise HTTPException(status_code=404, detail="No memes found")
+
+    headers = {}
+    if len(memes) == size:
+        headers['X-Next-Cursor'] = encode_user_memes_cursor(memes[-1])
+
+    body = memes_private_adapter.dump_json(
+        [ShowMemesPrivate(id=meme.id, description=meme.description, image_url=meme.image_url, created_at=meme.created_at) for meme in memes]
+    )
+    return Response(body, media_type='application/json', headers=headers)
+
+
 @_private_router.get('/{meme_id}', response_model=ShowMemesPrivate)
-async def get_meme(meme_id: int, db: AsyncSession = Depends(get_db), author: User = Depends(get_current_user_from_token)):
+async def get_meme(meme_id: int, db: AsyncSession = Depends(get_db), author: CurrentUser = Depends(get_current_user_from_token)):
     meme = await get_meme_from_db(db, meme_id)
     if not meme:
         raise HTTPException(status_code=404, detail=f"Meme number {meme_id} does not exist.")
@@ -46,7 +119,13 @@ async def get_meme(meme_id: int, db: AsyncSession = Depends(get_db), author: Use
 
 
 @_private_router.get('/image/{meme_id}')
-async def get_meme_image(meme_id: int, db: AsyncSession = Depends(get_db), author: User = Depends(get_current_user_from_token)):
+async def get_meme_image(
+    meme_id: int,
+    request: Request,
+    size: Optional[str]=Query(None, description='Размер изображения: thumb, medium, original или ширина в пикселях'),
+    delivery: Optional[str]=Query(None, pattern='^(proxy|redirect)$', description='proxy - отдать изображение, redirect - перенаправить на подписанную ссылку хранилища'),
+    db: AsyncSession = Depends(get_db), author: CurrentUser = Depends(get_current_user_from_token)
+):
     meme = await get_meme_from_db(db, meme_id)
     if not meme:
         raise HTTPException(status_code=404, detail=f"Meme number {meme_id} does not exist.")
@@ -54,57 +133,78 @@ async def get_meme_image(meme_id: int, db: AsyncSession = Depends(get_db), autho
     if meme.user_id != author.id:
         raise HTTPException(status_code=404, detail=f"Only the author can access this meme.")
     
+    variant = nearest_variant(size)
+    redirect = (delivery or IMAGE_DELIVERY) == 'redirect'
     try:
-        bucket_name = 'memes'
-        file_name = meme.image_url.split('/')[-1]
-
-        try:
-            response = minio_client.get_object(bucket_name, file_name)
-            content = response.read()
-            response.close()
-            response.release_conn()
-            return Response(content=content, media_type="image/jpeg")
-        except S3Error as err:
-            raise HTTPException(status_code=500, detail=f"MinIO error: {err}")
+        stat = await stat_image(meme.image_url, variant) if variant else None
+        if stat is None:
+            # variants are built in the background, serve the original until they are ready
+            variant = None
+            if not redirect:
+                stat = await stat_image(meme.image_url)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving meme image: {e}")
 
+    if redirect:
+        # the client downloads straight from the store, no image bytes go through the app
+        return RedirectResponse(presigned_image_url(meme.image_url, variant), status_code=302)
+
+    etag = f'"{stat.etag}"'
+    last_modified = format_datetime(stat.last_modified, usegmt=True)
+    media_type = stat.content_type if stat.content_type and stat.content_type.startswith('image/') else 'image/jpeg'
+    headers = {'Accept-Ranges': 'bytes', 'ETag': etag, 'Last-Modified': last_modified}
+
+    file_path = image_file_path(meme.image_url, variant)
+    if file_path is not None:
+        # sent from disk by the server (pathsend) when it supports it, ranges included
+        return FileResponse(file_path, media_type=media_type, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get('range')
+    if range_header and if_range_matches(request.headers.get('if-range'), etag, last_modified):
+        byte_range = parse_range_header(range_header, stat.size)
+
+    if byte_range is None:
+        headers['Content-Length'] = str(stat.size)
+        return StreamingResponse(stream_image(meme.image_url, variant=variant), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{stat.size}'
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingResponse(
+        stream_image(meme.image_url, offset=start, length=end - start + 1, variant=variant),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+    )
+
 
 @_private_router.patch('/{meme_id}', response_model=StatusResponse)
 async def update_meme(
     meme_id: int,
     file: UploadFile=File(None),
     description: str=None,
-    db: AsyncSession=Depends(get_db), author: User=Depends(get_current_user_from_token)
+    db: AsyncSession=Depends(get_db), author: CurrentUser=Depends(get_current_user_from_token)
 ):
-    meme = await get_meme_from_db(db, meme_id)
-    if not meme:
-        raise HTTPException(status_code=404, detail=f"Meme number {meme_id} does not exist.")
-
-    if meme.user_id != author.id:
-        raise HTTPException(status_code=404, detail=f"Only the author can update this meme.")  
-
     try:
-        file = validate_image(file)
-        await save_meme(db, meme_id, description, file)
+        if file:
+            file = validate_image(file)
+        updated = await save_meme(db, meme_id, description, file, author)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload image: {e}")
+
+    if not updated:
+        raise await meme_not_available(db, meme_id, 'update')
     return StatusResponse(status="ok", message="Meme updated successfully")
 
 
 @_private_router.delete('/{meme_id}', response_model=StatusResponse)
-async def delete_meme(meme_id: int, db: AsyncSession = Depends(get_db), author: User = Depends(get_current_user_from_token)):
-    meme = await get_meme_from_db(db, meme_id)
-    if not meme:
-        raise HTTPException(status_code=404, detail=f"Meme number {meme_id} does not exist.")
-
-    if meme.user_id != author.id:
-        raise HTTPException(status_code=404, detail=f"Only the author can delete this meme.") 
-
+async def delete_meme(meme_id: int, db: AsyncSession = Depends(get_db), author: CurrentUser = Depends(get_current_user_from_token)):
     try:
-        await delete_meme_in_db(db, meme_id, meme.image_url)
-
-        return StatusResponse(status="ok", message=f"Meme number {meme_id} deleted successfully")
-
+        deleted = await delete_meme_in_db(db, meme_id, author.id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete meme: {e}")
+
+    if not deleted:
+        raise await meme_not_available(db, meme_id, 'delete')
+    return StatusResponse(status="ok", message=f"Meme number {meme_id} deleted successfully")
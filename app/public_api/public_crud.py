@@ -1,49 +1,167 @@
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from sqlalchemy import desc
+from sqlalchemy import REAL, cast, desc, event, func, inspect, tuple_
+from sqlalchemy.engine import Row
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from starlette import status
 
-from config import ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, SECRET_KEY
+from config import (ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, AUTH_CACHE_SIZE,
+                    AUTH_CACHE_TTL, AUTH_STATELESS, AUTH_TOKEN_VERSION,
+                    SECRET_KEY)
 from database.db import get_db
-from database.models import Meme
-from database.schemas import ShowUser, UserCreate
-from utils import Hasher, UserDAL
+from database.models import SEARCH_CONFIG, Meme, User
+from database.schemas import CurrentUser, ShowUser, UserCreate
+from profiling import phase
+from utils import (Hasher, TTLCache, UserDAL, cursor_int, pack_cursor,
+                   unpack_cursor)
 
 
-async def get_list_memes(
-            db: AsyncSession,
+# the only sort keys accepted by the listing, each backed by an index ending in id:
+# the primary key and ix_memes_created_at_id
+KEYSET_SORT_COLUMNS = {
+    'id': Meme.id,
+    'created_at': Meme.created_at,
+}
+SortKey = Literal['id', 'created_at']
+
+# larger values would overflow the bigint OFFSET of page * size
+MAX_PAGE = 2**31 - 1
+
+
+def _sort_keys(sort_by: str) -> list:
+    """Sort column plus id as a tiebreak, so the order is total."""
+    if sort_by == 'id':
+        return [Meme.id]
+    return [KEYSET_SORT_COLUMNS[sort_by], Meme.id]
+
+
+def encode_cursor(meme, sort_by: str, sort_desc: bool) -> str:
+    """Opaque cursor pointing right after the given meme, an entity or a row."""
+    values = []
+    for column in _sort_keys(sort_by):
+        value = getattr(meme, column.key)
+        values.append(value.isoformat() if isinstance(value, datetime) else value)
+
+    return pack_cursor({'s': sort_by, 'd': sort_desc, 'k': values})
+
+
+def decode_cursor(cursor: str, sort_by: str, sort_desc: bool) -> list:
+    invalid_cursor = HTTPException(status_code=400, detail='Invalid cursor')
+    payload = unpack_cursor(cursor)
+    values = payload['k']
+
+    if payload.get('s') != sort_by or payload.get('d') != sort_desc or sort_by not in KEYSET_SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail='Cursor does not match the requested sorting')
+
+    columns = _sort_keys(sort_by)
+    if len(values) != len(columns):
+        raise invalid_cursor
+
+    try:
+        return [
+            datetime.fromisoformat(value) if column.key == 'created_at' else cursor_int(value)
+            for column, value in zip(columns, values)
+        ]
+    except (ValueError, TypeError, OverflowError):
+        raise invalid_cursor
+
+
+def encode_search_cursor(rank: float, meme_id: int, q: str) -> str:
+    """Cursor pointing right after the search result with this rank and id."""
+    return pack_cursor({'s': 'rank', 'q': q, 'k': [rank, meme_id]})
+
+
+def decode_search_cursor(cursor: str, q: str) -> list:
+    payload = unpack_cursor(cursor)
+    if payload.get('s') != 'rank' or payload.get('q') != q:
+        raise HTTPException(status_code=400, detail='Cursor does not match the search query')
+
+    try:
+        rank, meme_id = payload['k']
+        return [float(rank), cursor_int(meme_id)]
+    except (ValueError, TypeError, OverflowError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def list_memes_query(
             page: int,
             size: int,
-            sort_by: str='id',
-            sort_desc: bool=False) -> List[Meme]:
-   
-    query = select(Meme).offset(page*size).limit(size)
+            sort_by: SortKey='id',
+            sort_desc: bool=False,
+            cursor: Optional[str]=None):
+
+    sort_keys = _sort_keys(sort_by)
+    # only the public columns, as plain rows: no entity or identity map bookkeeping
+    query = select(Meme.id, Meme.description, Meme.created_at).limit(size)
 
     # sorting
     if sort_desc:
-        query = query.order_by(desc(getattr(Meme, sort_by)))
+        query = query.order_by(*[desc(column) for column in sort_keys])
+    else:
+        query = query.order_by(*sort_keys)
+
+    # pagination: keyset when a cursor is given, so deep pages cost the same as the first one
+    if cursor:
+        last_values = decode_cursor(cursor, sort_by, sort_desc)
+        key, last_key = tuple_(*sort_keys), tuple_(*last_values)
+        query = query.where(key < last_key if sort_desc else key > last_key)
     else:
-        query = query.order_by(getattr(Meme, sort_by))
+        query = query.offset(page*size)
+
+    return query
 
-    result = await db.execute(query)
-    memes = result.scalars().all()
+
+async def get_list_memes(
+            db: AsyncSession,
+            page: int,
+            size: int,
+            sort_by: SortKey='id',
+            sort_desc: bool=False,
+            cursor: Optional[str]=None) -> List[Row]:
+
+    result = await db.execute(list_memes_query(page, size, sort_by, sort_desc, cursor))
+    memes = result.all()
     return memes
 
 
+async def search_memes(db: AsyncSession, q: str, size: int, cursor: Optional[str]=None) -> list:
+    """
+    Memes whose description matches the query, best ranked first.
+    Returns (id, description, created_at, rank) rows, ties on the rank are broken by id.
+    """
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+    # real, as returned by ts_rank, so cursor values compare exactly
+    rank = cast(func.ts_rank(Meme.search_vector, query), REAL)
+
+    statement = (
+        select(Meme.id, Meme.description, Meme.created_at, rank.label('rank'))
+        .where(Meme.search_vector.op('@@')(query))
+        .order_by(desc(rank), desc(Meme.id))
+        .limit(size)
+    )
+    if cursor:
+        last_rank, last_id = decode_search_cursor(cursor, q)
+        statement = statement.where(tuple_(rank, Meme.id) < tuple_(last_rank, last_id))
+
+    result = await db.execute(statement)
+    return result.all()
+
+
 async def create_new_user(body: UserCreate, db: AsyncSession) -> ShowUser:
+    # hash before opening the transaction, bcrypt takes a while
+    hashed_password = await Hasher.get_password_hash_async(body.password)
     async with db.begin():
         user_dal = UserDAL(db)
         user = await user_dal.create_user(
             name=body.name,
             surname=body.surname,
             email=body.email,
-            hashed_password=Hasher.get_password_hash(body.password),
+            hashed_password=hashed_password,
 
         )
         return ShowUser(
@@ -70,8 +188,13 @@ async def authenticate_user(
     user = await get_user_by_email_for_auth(email=email, db=db)
     if user is None:
         return
-    if not Hasher.verify_password(password, user.hashed_password):
+    verified, new_hash = await Hasher.verify_and_update_async(password, user.hashed_password)
+    if not verified:
         return
+    if new_hash:
+        # the hash was made with outdated settings (e.g. a lower bcrypt cost)
+        async with db.begin():
+            await UserDAL(db).update_password(user, new_hash)
     return user
 
 
@@ -82,9 +205,27 @@ ACCESS_TOKEN_EXPIRE_MINUTES = ACCESS_TOKEN_EXPIRE_MINUTES
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/user/token')
 
+# users resolved from tokens, keyed by the token subject (email)
+user_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target: User):
+    user_cache.pop(target.email)
+    # the user may have been cached under the email it had before the update
+    for old_email in inspect(target).attrs.email.history.deleted:
+        user_cache.pop(old_email)
+
+
 async def get_current_user_from_token(
         token: str=Depends(oauth2_scheme), db: AsyncSession=Depends(get_db)
-):
+) -> CurrentUser:
+    with phase('auth'):
+        return await resolve_user(token, db)
+
+
+async def resolve_user(token: str, db: AsyncSession) -> CurrentUser:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
@@ -100,9 +241,17 @@ async def get_current_user_from_token(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = await get_user_by_email_for_auth(email=email, db=db)
+
+    if AUTH_STATELESS and payload.get('uid') and payload.get('ver') == AUTH_TOKEN_VERSION:
+        return CurrentUser(id=payload['uid'], email=email)
+
+    user = user_cache.get(email)
     if user is None:
-        raise credentials_exception
+        db_user = await get_user_by_email_for_auth(email=email, db=db)
+        if db_user is None:
+            raise credentials_exception
+        user = CurrentUser.model_validate(db_user)
+        user_cache.set(email, user)
     return user
 
 
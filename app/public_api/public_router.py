@@ -1,25 +1,114 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+import hashlib
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from config import RESPONSE_CACHE_MAX_PAGE
 from database.db import get_db
+from database.models import Meme
 from database.schemas import ShowMemesPublic
+from response_cache import pack_response, response_cache, unpack_response
+from utils import (count_rows, dumps_json, get_table_version, http_date,
+                   is_not_modified)
 
-from .public_crud import get_list_memes
+from .public_crud import (MAX_PAGE, SortKey, decode_cursor, encode_cursor,
+                          encode_search_cursor, get_list_memes, search_memes)
 
 _public_router = APIRouter()
 
 
+def dump_memes_public(rows: list) -> bytes:
+    """
+    ShowMemesPublic list as JSON, straight from (id, description, created_at) rows.
+    The rows come from the database already valid, so no model is built per row.
+    """
+    return dumps_json([{'description': row.description, 'id': row.id, 'created_at': row.created_at} for row in rows])
+
+
+def listing_etag(version: int, params: dict) -> str:
+    """Weak ETag of one listing page: the table version plus the query, so it only ever matches that page."""
+    query = '&'.join(f'{name}={value}' for name, value in params.items())
+    return f'W/"memes-{version}-{hashlib.blake2b(query.encode(), digest_size=8).hexdigest()}"'
+
+
+def not_modified_response(request: Request, headers: dict) -> Optional[Response]:
+    last_modified = headers.get('Last-Modified')
+    if is_not_modified(request.headers.get('if-none-match'), request.headers.get('if-modified-since'),
+                       headers['ETag'], parsedate_to_datetime(last_modified) if last_modified else None):
+        validators = {name: headers[name] for name in ('ETag', 'Last-Modified') if name in headers}
+        return Response(status_code=304, headers=validators)
+    return None
+
+
 @_public_router.get('/', response_model=list[ShowMemesPublic])
 async def get_memes(
+    request: Request,
     db: AsyncSession = Depends(get_db),     
-    page: int=Query(0, ge=0, description="Номер страницы."),
-    size: int=Query(10, le=100, description="Количество записей на странице"),
-    sort_by: str=Query('id', description='Сортировка по значению'),
-    sort_desc: bool=Query(False, description='Сортировка в обратном порядке')) -> list[ShowMemesPublic]:
+    page: int=Query(0, ge=0, le=MAX_PAGE, description="Номер страницы."),
+    size: int=Query(10, ge=1, le=100, description="Количество записей на странице"),
+    sort_by: SortKey=Query('id', description='Сортировка по значению: id или created_at'),
+    sort_desc: bool=Query(False, description='Сортировка в обратном порядке'),
+    cursor: Optional[str]=Query(None, description='Курсор следующей страницы (заголовок X-Next-Cursor)')) -> list[ShowMemesPublic]:
+
+    # a malformed cursor is a 400 even for a request that would otherwise be answered with a 304
+    if cursor:
+        decode_cursor(cursor, sort_by, sort_desc)
+    params = {'page': page, 'size': size, 'sort_by': sort_by, 'sort_desc': sort_desc, 'cursor': cursor}
+
+    # the first pages are served from the response cache, keyed by the normalized query
+    cache_key = None
+    if cursor is None and page < RESPONSE_CACHE_MAX_PAGE:
+        cache_key = await response_cache.key(
+            Meme.__tablename__, {'page': page, 'size': size, 'sort_by': sort_by, 'sort_desc': sort_desc}
+        )
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            headers, body = unpack_response(cached)
+            return not_modified_response(request, headers) or Response(body, media_type='application/json', headers=headers)
+
+    # conditional GET: validated against the table version, without reading the rows
+    version, last_modified = await get_table_version(db, Meme.__tablename__)
+    headers = {'ETag': listing_etag(version, params)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    not_modified = not_modified_response(request, headers)
+    if not_modified is not None:
+        return not_modified
 
-    memes = await get_list_memes(db=db, page=page, size=size, sort_by=sort_by, sort_desc=sort_desc)
+    memes = await get_list_memes(db=db, page=page, size=size, sort_by=sort_by, sort_desc=sort_desc, cursor=cursor)
    
     if not memes:
         raise HTTPException(status_code=404, detail="No memes found")
-   
-    return [ShowMemesPublic(id=meme.id, description=meme.description, created_at=meme.created_at) for meme in memes]
+
+    if len(memes) == size:
+        headers['X-Next-Cursor'] = encode_cursor(memes[-1], sort_by, sort_desc)
+    headers['X-Total-Count'] = str(await count_rows(db, Meme.__table__, version))
+
+    body = dump_memes_public(memes)
+    if cache_key is not None:
+        await response_cache.set(cache_key, pack_response(headers, body))
+
+    return Response(body, media_type='application/json', headers=headers)
+
+
+@_public_router.get('/search', response_model=list[ShowMemesPublic])
+async def search(
+    db: AsyncSession = Depends(get_db),
+    q: str=Query(..., min_length=1, max_length=200, description='Поисковый запрос по описанию мема'),
+    size: int=Query(10, ge=1, le=100, description="Количество записей на странице"),
+    cursor: Optional[str]=Query(None, description='Курсор следующей страницы (заголовок X-Next-Cursor)')) -> list[ShowMemesPublic]:
+
+    results = await search_memes(db, q=q, size=size, cursor=cursor)
+    if not results:
+        raise HTTPException(status_code=404, detail="No memes found")
+
+    headers = {}
+    if len(results) == size:
+        last = results[-1]
+        headers['X-Next-Cursor'] = encode_search_cursor(last.rank, last.id, q)
+
+    body = dump_memes_public(results)
+    return Response(body, media_type='application/json', headers=headers)
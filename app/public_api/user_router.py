@@ -4,6 +4,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from config import AUTH_TOKEN_VERSION
 from database.db import get_db
 from database.schemas import ShowUser, Token, UserCreate
 
@@ -36,7 +37,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm=Depends(),
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={'sub': user.email, 'other_custom_data': [1, 2, 3, 4]},
+        data={'sub': user.email, 'uid': str(user.id), 'ver': AUTH_TOKEN_VERSION, 'other_custom_data': [1, 2, 3, 4]},
         expires_delta=access_token_expires,
     )
     return {'access_token': access_token, 'token_type': 'bearer'}
@@ -0,0 +1,27 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import FileResponse
+
+import storage
+from storage import FilesystemStorage
+
+_storage_router = APIRouter()
+
+
+@_storage_router.get('/{name:path}')
+async def download_object(name: str, expires: int=Query(...), signature: str=Query(...)):
+    """Presigned download of the filesystem store, the counterpart of a presigned MinIO URL."""
+    backend = storage.backend
+    if not isinstance(backend, FilesystemStorage):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if not backend.verify(name, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired signature.")
+
+    try:
+        info = await storage.run_in_storage_pool(backend.stat, name)
+    except storage.StorageError:
+        info = None
+    if info is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    return FileResponse(backend.local_path(name), media_type=info.content_type or 'application/octet-stream')
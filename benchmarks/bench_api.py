@@ -0,0 +1,237 @@
+"""
+Latency and throughput of the API, driven in-process through httpx.
+
+main.app runs against a local Postgres (BENCH_DATABASE_URL, the test database
+by default; its tables are created and dropped) and an in-memory MinIO
+stand-in, so the numbers reflect the app itself. Every scenario runs at each
+concurrency level and reports p50/p99 latency, requests per second and the
+peak RSS of the process, one JSON object per line.
+
+    python -m benchmarks.bench_api --requests 500 --concurrency 1 8 32 --output after.json
+    python -m benchmarks.bench_api --scenarios list image --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import time
+from typing import Optional
+
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import storage
+from benchmarks.fake_minio import FakeMinio
+from config import (DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_TEST_HOST, DB_TEST_NAME,
+                    DB_TEST_PASS, DB_TEST_PORT, DB_TEST_USER)
+from database.db import Base, get_db
+from main import app
+from utils import shutdown_hash_executor
+
+DATABASE_URL = os.getenv(
+    'BENCH_DATABASE_URL',
+    f"postgresql+asyncpg://{DB_TEST_USER}:{DB_TEST_PASS}@{DB_TEST_HOST}:{DB_TEST_PORT}/{DB_TEST_NAME}",
+)
+
+with open('tests/fixtures/test_image_2.jpeg', 'rb') as f:
+    IMAGE = f.read()
+
+EMAIL, PASSWORD = 'bench@example.com', 'benchpassword'
+
+
+class Context:
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.headers = {}
+        self.meme_ids = []
+        self.spare_ids = []
+
+    def image(self) -> bytes:
+        # trailing bytes are ignored by decoders, but every upload is new content
+        return IMAGE + os.urandom(16)
+
+    async def upload_batch(self, count: int) -> list:
+        ids = []
+        for start in range(0, count, 100):
+            files = [('files', (f'meme{index}.jpg', self.image(), 'image/jpeg')) for index in range(min(100, count - start))]
+            response = await self.client.post('/memes/batch', files=files, headers=self.headers)
+            response.raise_for_status()
+            ids += [item['id'] for item in response.json()['items']]
+        return ids
+
+
+async def list_memes(ctx: Context) -> httpx.Response:
+    return await ctx.client.get('/memes/', params={'page': 0, 'size': 10})
+
+
+async def login(ctx: Context) -> httpx.Response:
+    return await ctx.client.post('/user/token', data={'username': EMAIL, 'password': PASSWORD})
+
+
+async def upload(ctx: Context) -> httpx.Response:
+    files = {'file': ('meme.jpg', ctx.image(), 'image/jpeg')}
+    return await ctx.client.post('/memes/', files=files, params={'description': 'benchmark'}, headers=ctx.headers)
+
+
+async def fetch_image(ctx: Context) -> httpx.Response:
+    return await ctx.client.get(f'/memes/image/{random.choice(ctx.meme_ids)}', headers=ctx.headers)
+
+
+async def update(ctx: Context) -> httpx.Response:
+    params = {'description': f'updated {random.random()}'}
+    return await ctx.client.patch(f'/memes/{random.choice(ctx.meme_ids)}', params=params, headers=ctx.headers)
+
+
+async def delete(ctx: Context) -> httpx.Response:
+    return await ctx.client.delete(f'/memes/{ctx.spare_ids.pop()}', headers=ctx.headers)
+
+
+async def prepare_delete(ctx: Context, requests: int):
+    ctx.spare_ids = await ctx.upload_batch(requests)
+
+
+# name: (request, untimed preparation before each concurrency level)
+SCENARIOS = {
+    'list': (list_memes, None),
+    'auth': (login, None),
+    'upload': (upload, None),
+    'image': (fetch_image, None),
+    'update': (update, None),
+    'delete': (delete, prepare_delete),
+}
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def peak_rss_mib() -> float:
+    # kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+async def run_level(ctx: Context, request, concurrency: int, requests: int) -> dict:
+    latencies, errors = [], 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            response = await request(ctx)
+            latencies.append(time.perf_counter() - started)
+            errors += response.status_code >= 400
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+
+async def setup(ctx: Context):
+    await ctx.client.post('/user/sign-up', json={'name': 'bench', 'surname': 'bench', 'email': EMAIL, 'password': PASSWORD})
+    response = await login(ctx)
+    response.raise_for_status()
+    ctx.headers = {'Authorization': f"Bearer {response.json()['access_token']}"}
+    ctx.meme_ids = await ctx.upload_batch(100)
+
+
+async def main(scenarios: list, levels: list, requests: int) -> list:
+    storage.backend = storage.MinioStorage(FakeMinio(), presign_client=None)
+
+    engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        execution_options={'isolation_level': 'AUTOCOMMIT'},
+    )
+    session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def get_bench_db():
+        async with session_maker() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = get_bench_db
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    results = []
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            ctx = Context(client)
+            await setup(ctx)
+            for name in scenarios:
+                request, prepare = SCENARIOS[name]
+                for concurrency in levels:
+                    if prepare is not None:
+                        await prepare(ctx, requests)
+                    result = {'scenario': name, 'concurrency': concurrency, **await run_level(ctx, request, concurrency, requests)}
+                    results.append(result)
+                    print(json.dumps(result), flush=True)
+    finally:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await engine.dispose()
+        app.dependency_overrides.pop(get_db, None)
+        shutdown_hash_executor()
+
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: str):
+    """Ratio to the baseline for each scenario and level, above 1 is better."""
+    with open(baseline_path) as f:
+        baseline = {(item['scenario'], item['concurrency']): item for item in json.load(f)['results']}
+
+    for result in results:
+        before = baseline.get((result['scenario'], result['concurrency']))
+        if before is None:
+            continue
+        print(json.dumps({
+            'scenario': result['scenario'],
+            'concurrency': result['concurrency'],
+            'rps': round(result['rps'] / before['rps'], 3),
+            'p50': round(before['p50_ms'] / result['p50_ms'], 3),
+            'p99': round(before['p99_ms'] / result['p99_ms'], 3),
+        }))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario and concurrency level')
+    parser.add_argument('--output', help='write the results with the commit and python version to this file')
+    parser.add_argument('--compare', help='results file of a previous run to compare against')
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args.scenarios, args.concurrency, args.requests))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(), 'results': results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
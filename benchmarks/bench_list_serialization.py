@@ -0,0 +1,106 @@
+"""
+Cost of building a GET /memes page: ORM entities and a pydantic model per row
+against projected rows serialized straight to JSON.
+
+Both paths run the same query shape against an in-memory SQLite copy of the
+memes table, so the numbers cover loading and serialization without network
+or Postgres time. Reports pages per second and the peak memory allocated
+while building one page, for each page size.
+
+    python -m benchmarks.bench_list_serialization --pages 2000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine, text
+from sqlalchemy.future import select
+from sqlalchemy.orm import Session
+
+from app.public_api.public_crud import list_memes_query
+from app.public_api.public_router import dump_memes_public
+from database.models import Meme
+from database.schemas import ShowMemesPublic
+
+memes_public_adapter = TypeAdapter(list[ShowMemesPublic])
+
+
+def entity_page(session: Session, size: int) -> bytes:
+    """The previous path: full entities, then one ShowMemesPublic per row."""
+    memes = session.execute(select(Meme).order_by(Meme.id).limit(size)).scalars().all()
+    body = memes_public_adapter.dump_json(
+        [ShowMemesPublic(id=meme.id, description=meme.description, created_at=meme.created_at) for meme in memes]
+    )
+    # a new session per request in the app, so the identity map starts empty every time
+    session.expunge_all()
+    return body
+
+
+def row_page(session: Session, size: int) -> bytes:
+    rows = session.execute(list_memes_query(0, size, 'id', False)).all()
+    return dump_memes_public(rows)
+
+
+def create_memes(session: Session, count: int):
+    session.execute(text(
+        "CREATE TABLE memes (id INTEGER PRIMARY KEY, description TEXT, image_url VARCHAR,"
+        " created_at DATETIME, user_id CHAR(32) NOT NULL)"
+    ))
+    started = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    user_id = uuid.uuid4().hex
+    session.execute(
+        text("INSERT INTO memes (id, description, image_url, created_at, user_id) VALUES (:id, :description, :image_url, :created_at, :user_id)"),
+        [
+            {
+                'id': index,
+                'description': f'meme number {index}',
+                'image_url': f'http://127.0.0.1:9001/memes/{index:064x}',
+                'created_at': started + timedelta(seconds=index),
+                'user_id': user_id,
+            }
+            for index in range(1, count + 1)
+        ],
+    )
+
+
+def measure(build, session: Session, size: int, pages: int) -> dict:
+    for _ in range(min(pages, 50)):
+        build(session, size)
+
+    started = time.perf_counter()
+    for _ in range(pages):
+        build(session, size)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    build(session, size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'pages_per_sec': round(pages / elapsed, 1), 'peak_kib_per_page': round(peak / 1024, 1)}
+
+
+def main(pages: int, sizes: list):
+    engine = create_engine('sqlite://')
+    results = []
+    with Session(engine) as session:
+        create_memes(session, max(sizes))
+        for size in sizes:
+            for name, build in (('entities', entity_page), ('rows', row_page)):
+                results.append({'path': name, 'size': size, 'pages': pages, **measure(build, session, size, pages)})
+                print(json.dumps(results[-1]))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=2000, help='pages built per path and size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100], help='page sizes to try')
+    args = parser.parse_args()
+
+    main(args.pages, args.sizes)
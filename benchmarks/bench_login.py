@@ -0,0 +1,67 @@
+"""
+Login throughput with bcrypt running in the hashing process pool.
+
+Runs concurrent password verifications the same way authenticate_user does
+and reports verifications per second for each pool size, up to the number of cores.
+
+    python -m benchmarks.bench_login --logins 200
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+from config import BCRYPT_ROUNDS
+from utils import Hasher
+
+
+def pool_sizes(max_size: int) -> list:
+    sizes, size = [], 1
+    while size < max_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max_size)
+    return sizes
+
+
+async def run_logins(executor: ProcessPoolExecutor, logins: int, password: str, hashed_password: str) -> float:
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        loop.run_in_executor(executor, Hasher.verify_and_update, password, hashed_password)
+        for _ in range(logins)
+    ])
+    return time.perf_counter() - started
+
+
+async def main(logins: int, rounds: int, max_workers: int):
+    password = 'benchmark-password'
+    hashed_password = CryptContext(schemes=['bcrypt'], bcrypt__rounds=rounds).hash(password)
+
+    results = []
+    for size in pool_sizes(max_workers):
+        with ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context('spawn')) as executor:
+            # warm up: start every worker before measuring
+            await run_logins(executor, size, password, hashed_password)
+            elapsed = await run_logins(executor, logins, password, hashed_password)
+
+        results.append({'workers': size, 'logins': logins, 'seconds': round(elapsed, 3), 'logins_per_sec': round(logins / elapsed, 1)})
+        print(json.dumps(results[-1]))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=200, help='verifications per pool size')
+    parser.add_argument('--rounds', type=int, default=BCRYPT_ROUNDS,
+                        help='bcrypt cost factor of the stored hash, a different value also measures rehash-on-login')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1, help='largest pool size to try')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.logins, args.rounds, args.max_workers))
@@ -0,0 +1,94 @@
+"""
+In-memory stand-in for the MinIO client, covering the calls the app makes.
+Keeps storage latency out of the API benchmarks.
+"""
+import hashlib
+import threading
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Optional
+
+from minio.commonconfig import CopySource
+from minio.datatypes import Object
+from minio.error import S3Error
+
+
+def _no_such_key(bucket_name: str, object_name: str) -> S3Error:
+    return S3Error(None, 'NoSuchKey', 'The specified key does not exist.', object_name, None, None,
+                   bucket_name=bucket_name, object_name=object_name)
+
+
+class FakeResponse(BytesIO):
+    """Body of get_object, read the same way as the urllib3 response."""
+
+    def release_conn(self):
+        pass
+
+
+class FakeMinio:
+    def __init__(self):
+        self._buckets = set()
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        return bucket_name in self._buckets
+
+    def make_bucket(self, bucket_name: str):
+        self._buckets.add(bucket_name)
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, part_size: int=0,
+                   content_type: str='application/octet-stream', **kwargs):
+        body = bytearray()
+        while True:
+            chunk = data.read(part_size or 64 * 1024)
+            if not chunk:
+                break
+            body += chunk
+        self._store(bucket_name, object_name, bytes(body), content_type)
+
+    def copy_object(self, bucket_name: str, object_name: str, source: CopySource, **kwargs):
+        body, content_type = self._get(source.bucket_name, source.object_name)
+        self._store(bucket_name, object_name, body, content_type)
+
+    def remove_object(self, bucket_name: str, object_name: str, **kwargs):
+        with self._lock:
+            self._objects.pop((bucket_name, object_name), None)
+
+    def remove_objects(self, bucket_name: str, delete_object_list, **kwargs):
+        for delete_object in delete_object_list:
+            self.remove_object(bucket_name, delete_object.name)
+        return iter(())
+
+    def stat_object(self, bucket_name: str, object_name: str, **kwargs) -> Object:
+        with self._lock:
+            item = self._objects.get((bucket_name, object_name))
+        if item is None:
+            raise _no_such_key(bucket_name, object_name)
+        body, content_type, etag, last_modified = item
+        return Object(bucket_name, object_name, last_modified=last_modified, etag=etag,
+                      size=len(body), content_type=content_type)
+
+    def get_object(self, bucket_name: str, object_name: str, offset: int=0, length: int=0, **kwargs) -> FakeResponse:
+        body, _ = self._get(bucket_name, object_name)
+        end = offset + length if length else len(body)
+        return FakeResponse(body[offset:end])
+
+    def list_objects(self, bucket_name: str, prefix: Optional[str]=None, recursive: bool=False, **kwargs):
+        with self._lock:
+            items = [(name, item) for (bucket, name), item in self._objects.items() if bucket == bucket_name]
+        for name, (body, content_type, etag, last_modified) in sorted(items):
+            if prefix is None or name.startswith(prefix):
+                yield Object(bucket_name, name, last_modified=last_modified, etag=etag, size=len(body))
+
+    def _store(self, bucket_name: str, object_name: str, body: bytes, content_type: str):
+        etag = hashlib.md5(body).hexdigest()
+        with self._lock:
+            self._objects[(bucket_name, object_name)] = (body, content_type, etag, datetime.now(timezone.utc))
+
+    def _get(self, bucket_name: str, object_name: str):
+        with self._lock:
+            item = self._objects.get((bucket_name, object_name))
+        if item is None:
+            raise _no_such_key(bucket_name, object_name)
+        return item[0], item[1]
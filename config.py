@@ -1,17 +1,100 @@
+import os
+
 DB_HOST = 'db'
 DB_PORT = '5432'
 DB_NAME = 'postgres'
 DB_USER = 'postgres'
 DB_PASS = 'postgres'
 
+# database engine and connection pool
+DB_ECHO = os.getenv('DB_ECHO', 'false').lower() == 'true'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# prepared statements cached per connection, set to 0 behind pgbouncer in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 100))
+
 MINIO_ENDPOINT = 'minio:9000'
 MINIO_ACCESS_KEY = 'minioadmin'
 MINIO_SECRET_KEY = 'minioadmin'
+# address of MinIO as seen by clients, used in presigned URLs
+MINIO_PUBLIC_ENDPOINT = os.getenv('MINIO_PUBLIC_ENDPOINT', MINIO_ENDPOINT)
+MINIO_PUBLIC_SECURE = os.getenv('MINIO_PUBLIC_SECURE', 'false').lower() == 'true'
+MINIO_REGION = os.getenv('MINIO_REGION', 'us-east-1')
+# size of the storage thread pool and of the MinIO connection pool,
+# keep it in line with the number of concurrent requests a worker serves
+MINIO_POOL_SIZE = int(os.getenv('MINIO_POOL_SIZE', 32))
+# images are streamed to clients in chunks of this size (bytes)
+IMAGE_CHUNK_SIZE = int(os.getenv('IMAGE_CHUNK_SIZE', 64 * 1024))
+# resized copies made in the background after an upload, as name:max_side_in_pixels
+IMAGE_VARIANTS = {
+    name: int(max_side)
+    for name, max_side in (
+        variant.split(':') for variant in os.getenv('IMAGE_VARIANTS', 'thumb:200,medium:800').split(',') if variant
+    )
+}
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', 2))
+# POST /memes/batch: files per request and uploads to MinIO running at once
+BATCH_UPLOAD_MAX_FILES = int(os.getenv('BATCH_UPLOAD_MAX_FILES', 100))
+BATCH_UPLOAD_CONCURRENCY = int(os.getenv('BATCH_UPLOAD_CONCURRENCY', 8))
+BATCH_DELETE_MAX_IDS = int(os.getenv('BATCH_DELETE_MAX_IDS', 1000))
+# python -m reconcile: age under which unreferenced objects are kept, objects checked at once
+RECONCILE_GRACE_HOURS = float(os.getenv('RECONCILE_GRACE_HOURS', 24))
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', 1000))
+# 'proxy' streams images through the app, 'redirect' answers with a presigned MinIO URL
+IMAGE_DELIVERY = os.getenv('IMAGE_DELIVERY', 'proxy')
+PRESIGNED_URL_EXPIRES = int(os.getenv('PRESIGNED_URL_EXPIRES', 15 * 60))
+# cached presigned URLs are renewed this many seconds before they expire
+PRESIGNED_URL_MARGIN = int(os.getenv('PRESIGNED_URL_MARGIN', 60))
+# where images are kept: 'minio', or 'filesystem' for a local directory on single-node deployments
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'minio')
+STORAGE_PATH = os.getenv('STORAGE_PATH', '/data/memes')
+# base URL of the app in presigned links of the filesystem store, and the key signing them,
+# required with the filesystem store
+STORAGE_PUBLIC_URL = os.getenv('STORAGE_PUBLIC_URL', 'http://127.0.0.1:8000')
+STORAGE_URL_SECRET = os.getenv('STORAGE_URL_SECRET')
+
+# cache of the first pages of GET /memes, in-process and optionally shared (redis://...)
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 30))
+RESPONSE_CACHE_MAX_PAGE = int(os.getenv('RESPONSE_CACHE_MAX_PAGE', 5))
+RESPONSE_CACHE_URL = os.getenv('RESPONSE_CACHE_URL')
+# X-Total-Count: exact below this many rows, the planner's estimate above, cached for TOTAL_COUNT_TTL seconds
+TOTAL_COUNT_EXACT_LIMIT = int(os.getenv('TOTAL_COUNT_EXACT_LIMIT', 10000))
+TOTAL_COUNT_TTL = float(os.getenv('TOTAL_COUNT_TTL', 10))
 
 SECRET_KEY = 'secret_key'
 ALGORITHM = 'HS256'
 ACCESS_TOKEN_EXPIRE_MINUTES = 240
 
+# resolved users are cached in-process by token subject
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', 10000))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', 60))
+# stateless mode trusts the user id carried by the token and skips the lookup,
+# bump the version to revoke every token issued before
+AUTH_STATELESS = os.getenv('AUTH_STATELESS', 'false').lower() == 'true'
+AUTH_TOKEN_VERSION = int(os.getenv('AUTH_TOKEN_VERSION', 1))
+
+# bcrypt runs in a process pool of this size, away from the event loop;
+# hashes made with a different cost are upgraded on the next login
+HASHER_POOL_SIZE = int(os.getenv('HASHER_POOL_SIZE', os.cpu_count() or 1))
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+
+# per-request profiling, also switched at runtime through /admin/profiling;
+# requests over either limit are logged with their statements
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILING_MAX_QUERIES = int(os.getenv('PROFILING_MAX_QUERIES', 20))
+PROFILING_SLOW_MS = float(os.getenv('PROFILING_SLOW_MS', 500))
+
+# the /admin endpoints are disabled while unset
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# limits of a sampling profile taken through /admin/profile
+SAMPLER_MAX_SECONDS = float(os.getenv('SAMPLER_MAX_SECONDS', 60))
+SAMPLER_MAX_RATE = float(os.getenv('SAMPLER_MAX_RATE', 1000))
+
 DB_TEST_HOST = 'db'
 DB_TEST_PORT = '5432'
 DB_TEST_NAME = 'postgres_test'
@@ -4,14 +4,26 @@ from typing import AsyncGenerator
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
-from config import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER
+from config import (DB_ECHO, DB_HOST, DB_MAX_OVERFLOW, DB_NAME, DB_PASS,
+                    DB_POOL_PRE_PING, DB_POOL_RECYCLE, DB_POOL_SIZE,
+                    DB_POOL_TIMEOUT, DB_PORT, DB_STATEMENT_CACHE_SIZE, DB_USER)
 
 REAL_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 engine = create_async_engine(
     REAL_DATABASE_URL,
     future=True,
-    echo=True,
+    echo=DB_ECHO,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={
+        # SQLAlchemy's cache of prepared statements and asyncpg's own one
+        "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+    },
     execution_options={"isolation_level": "AUTOCOMMIT"},
 )
 
@@ -1,12 +1,16 @@
 import uuid
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship
+from sqlalchemy import (BigInteger, Column, Computed, DateTime, ForeignKey,
+                        Index, Integer, String, Text)
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql import func
 
 from database.db import Base
 
+# text search configuration of memes.search_vector, the same one must be used in queries
+SEARCH_CONFIG = 'simple'
+
 
 class User(Base):
     """
@@ -35,8 +39,14 @@ class Meme(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     description = Column(Text)
-    image_url = Column(String, unique=True)
+    # memes with identical images share the stored object, see ImageObject
+    image_url = Column(String, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # kept up to date by Postgres, deferred so that loading memes does not read it
+    search_vector = deferred(Column(
+        TSVECTOR,
+        Computed(f"to_tsvector('{SEARCH_CONFIG}', coalesce(description, ''))", persisted=True),
+    ))
 
     user_id = Column(
         UUID(as_uuid=True),
@@ -45,3 +55,38 @@ class Meme(Base):
     )
 
     author = relationship('User', back_populates='memes')
+
+    __table_args__ = (
+        # keyset pagination over created_at with id as a tiebreak
+        Index('ix_memes_created_at_id', 'created_at', 'id'),
+        Index('ix_memes_search_vector', 'search_vector', postgresql_using='gin'),
+        # an author's memes newest first, also used by the cascade from users
+        Index('ix_memes_user_id_created_at_id', user_id, created_at.desc(), id),
+    )
+
+
+class TableVersion(Base):
+    """
+    Write counter of a table, bumped on every change of its rows.
+    Used to validate cached responses without reading the rows.
+    """
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class ImageObject(Base):
+    """
+    Stored image content, named by its SHA-256 and shared by every meme
+    with identical bytes. The object is deleted with the last reference.
+    """
+    __tablename__ = 'image_objects'
+
+    key = Column(String, primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # last reference taken, the reconcile job leaves the count of a recent upload alone
+    referenced_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
@@ -1,10 +1,10 @@
 import re
 import uuid
 from datetime import datetime
-from typing import Optional
+from typing import Annotated, Optional
 
 from fastapi import HTTPException, UploadFile
-from pydantic import BaseModel, EmailStr, field_validator
+from pydantic import BaseModel, EmailStr, Field, field_validator
 
 
 class BaseMeme(BaseModel):
@@ -36,6 +36,27 @@ class StatusResponse(BaseModel):
     message: str
 
 
+class BatchItemStatus(BaseModel):
+    index: int
+    status: str
+    id: Optional[int] = None
+    filename: Optional[str] = None
+    detail: Optional[str] = None
+
+
+# memes.id is a serial integer column, ids out of its range would overflow the parameter
+MemeId = Annotated[int, Field(ge=1, le=2**31 - 1)]
+
+
+class BatchDeleteRequest(BaseModel):
+    ids: list[MemeId] = Field(min_length=1)
+
+
+class BatchStatusResponse(BaseModel):
+    status: str
+    items: list[BatchItemStatus]
+
+
 LETTER_MATCH_PATTERN = re.compile(r'^[а-яА-Яa-zA-Z\-]+$')
 
 
@@ -77,6 +98,12 @@ class ShowUser(TunedModel):
     email: EmailStr
 
 
+class CurrentUser(TunedModel):
+    """Authenticated user as seen by the request handlers."""
+    id: uuid.UUID
+    email: str
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
\ No newline at end of file
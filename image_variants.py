@@ -0,0 +1,77 @@
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from typing import Optional
+
+from fastapi import HTTPException
+
+import storage
+from config import IMAGE_VARIANT_WORKERS, IMAGE_VARIANTS
+from storage import image_object_name
+
+try:
+    from PIL import Image
+except ImportError:  # resized variants are optional, originals are served instead
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# resizing is CPU-bound and slow, keep it off the storage pool serving requests
+variant_executor = ThreadPoolExecutor(max_workers=IMAGE_VARIANT_WORKERS, thread_name_prefix='variants')
+
+
+def nearest_variant(size: Optional[str]) -> Optional[str]:
+    """
+    Variant to serve for the requested size: a variant name, or a size in pixels
+    mapped to the smallest variant at least that big. None means the original.
+    """
+    if not size or size == 'original':
+        return None
+    if size in IMAGE_VARIANTS:
+        return size
+    if not size.isdigit():
+        raise HTTPException(status_code=422, detail=f"Unknown image size: {size}")
+
+    fitting = [name for name, max_side in IMAGE_VARIANTS.items() if max_side >= int(size)]
+    return min(fitting, key=IMAGE_VARIANTS.get) if fitting else None
+
+
+def _build_variants(image_url: str):
+    reader = storage.backend.open(image_object_name(image_url))
+    try:
+        data = reader.read()
+    finally:
+        reader.close()
+
+    with Image.open(BytesIO(data)) as image:
+        image_format = image.format or 'PNG'
+        for variant, max_side in IMAGE_VARIANTS.items():
+            # never upscale, the original is served for bigger sizes
+            if max(image.size) <= max_side:
+                continue
+
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side))
+            if image_format == 'JPEG' and resized.mode not in ('RGB', 'L'):
+                resized = resized.convert('RGB')
+
+            buffer = BytesIO()
+            resized.save(buffer, format=image_format)
+            buffer.seek(0)
+            storage.backend.put(
+                image_object_name(image_url, variant), buffer,
+                Image.MIME.get(image_format, 'application/octet-stream'), length=buffer.getbuffer().nbytes,
+            )
+
+
+def _log_failure(future: Future):
+    if future.exception() is not None:
+        logger.error("Failed to build image variants: %s", future.exception())
+
+
+def schedule_variants(image_url: str):
+    """Build the resized variants of a freshly uploaded image in the background."""
+    if Image is None or not IMAGE_VARIANTS:
+        return
+    future = variant_executor.submit(_build_variants, image_url)
+    future.add_done_callback(_log_failure)
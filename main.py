@@ -1,15 +1,37 @@
+from contextlib import asynccontextmanager
+
 import uvicorn
 import yaml
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.admin_api.admin_router import _admin_router
+from app.health_api.health_router import _health_router
+from app.metrics_api.metrics_router import _metrics_router
 from app.private_api.private_router import _private_router
+from app.public_api.public_crud import user_cache
 from app.public_api.public_router import _public_router
 from app.public_api.user_router import _user_router
+from app.storage_api.storage_router import _storage_router
+from image_variants import variant_executor
+from metrics import MetricsMiddleware, register_caches
+from profiling import ProfilingMiddleware
+from response_cache import response_cache
+from storage import presigned_url_cache, storage_executor
+from utils import shutdown_hash_executor
 
 origins = ["*"]
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    storage_executor.shutdown(wait=False, cancel_futures=True)
+    variant_executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_hash_executor()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,7 +39,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "ETag", "Last-Modified", "Server-Timing"],
 )
+app.add_middleware(ProfilingMiddleware)
+# outermost, so the time spent in the other middleware is counted too
+app.add_middleware(MetricsMiddleware)
+
+register_caches({'auth': user_cache, 'response': response_cache, 'presigned_url': presigned_url_cache})
 
 with open("docs.yaml", "r", encoding="utf8") as file:
     custom_openapi_schema = yaml.safe_load(file)
@@ -34,6 +62,10 @@ app.openapi = custom_openapi
 app.include_router(_public_router, prefix="/memes", tags=["public_api"])
 app.include_router(_private_router, prefix="/memes", tags=["private_api"])
 app.include_router(_user_router, prefix="/user", tags=["user"])
+app.include_router(_health_router, prefix="/health", tags=["health"])
+app.include_router(_storage_router, prefix="/storage", tags=["storage"])
+app.include_router(_metrics_router, prefix="/metrics", tags=["metrics"])
+app.include_router(_admin_router, prefix="/admin", tags=["admin"])
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
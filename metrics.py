@@ -0,0 +1,252 @@
+"""
+Prometheus metrics, rendered in the text exposition format by GET /metrics.
+
+Recording is meant to stay on under full load: every series is created once
+and then only updated in place (a bisect and a few integer additions), with
+no lock. Everything is recorded from the event loop thread, the storage
+timings included, since they are taken around run_in_storage_pool.
+"""
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import profiling
+from database.db import engine
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class _HistogramSeries:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # one slot per bucket plus +Inf, cumulated only when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _CounterSeries:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int=1):
+        self.value += amount
+
+
+class _Metric(ABC):
+    type = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str]=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        registry.append(self)
+
+    def header(self) -> list:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+    @abstractmethod
+    def render(self) -> list:
+        """Lines of the metric in the text exposition format."""
+
+
+class _SeriesMetric(_Metric):
+    """Metric recorded by the app, one series per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str]=()):
+        self._series: Dict[tuple, object] = {}
+        super().__init__(name, documentation, label_names)
+
+    @abstractmethod
+    def _new_series(self):
+        """Empty series for a new combination of label values."""
+
+    def labels(self, *values):
+        """Series of these label values, created on first use and reused afterwards."""
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = self._new_series()
+        return series
+
+
+class Histogram(_SeriesMetric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str]=(), buckets: Sequence[float]=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _new_series(self):
+        return _HistogramSeries(self.bounds)
+
+    def render(self) -> list:
+        lines = self.header()
+        for values, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.bounds, '+Inf'), series.counts):
+                cumulative += count
+                labels = _format_labels((*self.label_names, 'le'), (*values, bound))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.label_names, values)
+            lines.append(f'{self.name}_sum{labels} {series.sum}')
+            lines.append(f'{self.name}_count{labels} {series.count}')
+        return lines
+
+
+class Counter(_SeriesMetric):
+    type = 'counter'
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def render(self) -> list:
+        lines = self.header()
+        for values, series in list(self._series.items()):
+            lines.append(f'{self.name}_total{_format_labels(self.label_names, values)} {series.value}')
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """Value read when scraped, for state kept elsewhere: pool sizes, cache counters."""
+
+    def __init__(self, name: str, documentation: str, metric_type: str, callback: Callable[[], Dict[tuple, float]],
+                 label_names: Sequence[str]=()):
+        self.type = metric_type
+        self.callback = callback
+        super().__init__(name, documentation, label_names)
+
+    def render(self) -> list:
+        lines = self.header()
+        suffix = '_total' if self.type == 'counter' else ''
+        for values, value in self.callback().items():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.label_names, values)} {value}')
+        return lines
+
+
+registry = []
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+http_request_duration = Histogram(
+    'http_request_duration_seconds', 'Time to serve a request, by route template.', ('method', 'route'),
+)
+http_responses = Counter(
+    'http_responses', 'Responses sent, by route template and status code.', ('method', 'route', 'status'),
+)
+storage_operation_duration = Histogram(
+    'storage_operation_duration_seconds', 'Time of blocking image store calls, queueing in the storage pool included.', ('operation',),
+)
+db_query_duration = Histogram(
+    'db_query_duration_seconds', 'Time of SQL statements, from sending to the driver returning.',
+)
+db_query_errors = Counter('db_query_errors', 'SQL statements that raised an error.')
+
+
+def register_caches(caches: Dict[str, object]):
+    """Expose the hits and misses counters of the given caches."""
+    def collect(attribute: str) -> dict:
+        return {(name,): getattr(cache, attribute) for name, cache in caches.items()}
+
+    CallbackMetric('cache_hits', 'Cache lookups that found an entry.', 'counter', lambda: collect('hits'), ('cache',))
+    CallbackMetric('cache_misses', 'Cache lookups that found no entry.', 'counter', lambda: collect('misses'), ('cache',))
+
+
+def _pool_state() -> dict:
+    pool = engine.pool
+    return {
+        ('size',): pool.size(),
+        ('checked_out',): pool.checkedout(),
+        ('idle',): pool.checkedin(),
+        ('overflow',): max(pool.overflow(), 0),
+    }
+
+
+CallbackMetric('db_pool_connections', 'Connections of the database pool, by state.', 'gauge', _pool_state, ('state',))
+
+
+def route_template(scope) -> str:
+    """Path template of the matched route, with the prefix of its router."""
+    # routes of an included router keep their own path, the prefixed one is on the context
+    context = scope.get('fastapi', {}).get('effective_route_context')
+    if context is not None:
+        return context.path
+    route = scope.get('route')
+    return route.path if route is not None else 'unmatched'
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording latency and status per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the template, not the path, so ids do not create new series
+            path = route_template(scope)
+            http_request_duration.labels(scope['method'], path).observe(time.perf_counter() - started)
+            http_responses.labels(scope['method'], path, status).inc()
+
+
+# the only SQL timing listeners, feeding the histogram and the request profile; the start
+# time lives on the execution context, dropped with the statement even when it fails
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    db_query_duration.labels().observe(seconds)
+    profiling.record_query(statement, seconds)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _record_query_error(exception_context):
+    db_query_errors.labels().inc()
@@ -0,0 +1,36 @@
+"""image objects
+
+Revision ID: 5d9a2e61c8f3
+Revises: c41e7b2f90a6
+Create Date: 2026-10-18 11:47:52.290114
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '5d9a2e61c8f3'
+down_revision: Union[str, None] = 'c41e7b2f90a6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('image_objects',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('ref_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    # identical images are now shared between memes
+    op.drop_constraint('memes_image_url_key', 'memes', type_='unique')
+    op.create_index(op.f('ix_memes_image_url'), 'memes', ['image_url'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_memes_image_url'), table_name='memes')
+    op.create_unique_constraint('memes_image_url_key', 'memes', ['image_url'])
+    op.drop_table('image_objects')
@@ -0,0 +1,25 @@
+"""memes keyset index
+
+Revision ID: 8f3c1a9d4b27
+Revises: 2e5e7702cdeb
+Create Date: 2026-10-18 10:12:41.508213
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '8f3c1a9d4b27'
+down_revision: Union[str, None] = '2e5e7702cdeb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_memes_created_at_id', 'memes', ['created_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_memes_created_at_id', table_name='memes')
@@ -0,0 +1,40 @@
+"""memes search vector
+
+Revision ID: a7e4c0b19d35
+Revises: 5d9a2e61c8f3
+Create Date: 2026-10-18 13:05:27.840163
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7e4c0b19d35'
+down_revision: Union[str, None] = '5d9a2e61c8f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # a stored generated column rewrites the whole table under an ACCESS EXCLUSIVE lock,
+    # reads and writes of memes wait until it is done: run it in a maintenance window
+    op.add_column('memes', sa.Column(
+        'search_vector',
+        postgresql.TSVECTOR(),
+        sa.Computed("to_tsvector('simple', coalesce(description, ''))", persisted=True),
+        nullable=True,
+    ))
+    # CONCURRENTLY cannot run in a transaction, the index is built without blocking writes
+    with op.get_context().autocommit_block():
+        op.create_index('ix_memes_search_vector', 'memes', ['search_vector'], unique=False,
+                        postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_memes_search_vector', table_name='memes', postgresql_using='gin',
+                      postgresql_concurrently=True)
+    op.drop_column('memes', 'search_vector')
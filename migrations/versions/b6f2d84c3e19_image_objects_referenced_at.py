@@ -0,0 +1,25 @@
+"""image objects referenced_at
+
+Revision ID: b6f2d84c3e19
+Revises: e3b8d1f56a02
+Create Date: 2026-10-18 15:02:37.518240
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6f2d84c3e19'
+down_revision: Union[str, None] = 'e3b8d1f56a02'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('image_objects', sa.Column('referenced_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('image_objects', 'referenced_at')
@@ -0,0 +1,30 @@
+"""table versions
+
+Revision ID: c41e7b2f90a6
+Revises: 8f3c1a9d4b27
+Create Date: 2026-10-18 11:02:17.843105
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41e7b2f90a6'
+down_revision: Union[str, None] = '8f3c1a9d4b27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('table_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('table_versions')
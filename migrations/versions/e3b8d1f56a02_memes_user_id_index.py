@@ -0,0 +1,29 @@
+"""memes user_id index
+
+Revision ID: e3b8d1f56a02
+Revises: a7e4c0b19d35
+Create Date: 2026-10-18 13:41:09.172356
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3b8d1f56a02'
+down_revision: Union[str, None] = 'a7e4c0b19d35'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY cannot run in a transaction, the index is built without blocking writes
+    with op.get_context().autocommit_block():
+        op.create_index('ix_memes_user_id_created_at_id', 'memes', ['user_id', sa.text('created_at DESC'), 'id'],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_memes_user_id_created_at_id', table_name='memes', postgresql_concurrently=True)
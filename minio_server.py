@@ -1,48 +1,39 @@
-import uuid
+import os
 
-from fastapi import HTTPException, UploadFile
+import certifi
+import urllib3
 from minio import Minio
-from minio.error import S3Error
 
-from config import MINIO_ACCESS_KEY, MINIO_ENDPOINT, MINIO_SECRET_KEY
+from config import (MINIO_ACCESS_KEY, MINIO_ENDPOINT, MINIO_POOL_SIZE,
+                    MINIO_PUBLIC_ENDPOINT, MINIO_PUBLIC_SECURE, MINIO_REGION,
+                    MINIO_SECRET_KEY)
 
+# clients of the MinIO store, used through storage.MinioStorage
 minio_client = Minio(
     MINIO_ENDPOINT,
     access_key=MINIO_ACCESS_KEY,
     secret_key=MINIO_SECRET_KEY,
-    secure=False
+    secure=False,
+    # same settings as the default client, but with a connection pool
+    # big enough for every thread of the storage pool
+    http_client=urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=300, read=300),
+        maxsize=MINIO_POOL_SIZE,
+        cert_reqs='CERT_REQUIRED',
+        ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+        retries=urllib3.Retry(
+            total=5,
+            backoff_factor=0.2,
+            status_forcelist=[500, 502, 503, 504]
+        ),
+    ),
 )
 
-
-async def upload_image_to_minio(file: UploadFile) -> str:
-    bucket_name = 'memes'
-    if not minio_client.bucket_exists(bucket_name):
-        minio_client.make_bucket(bucket_name)
-
-    file_id = str(uuid.uuid4())
-    file_name = f"{file_id}_{file.filename}"
-
-    try:
-        minio_client.put_object(bucket_name, file_name, file.file, length=-1, part_size=10*1024*1024)
-    except S3Error as err:
-        raise HTTPException(status_code=500, detail=f"MinIO error: {err}")
-
-    return f"http://127.0.0.1:9001/{bucket_name}/{file_name}"
-
-
-async def delete_image_from_minio(image_url: str):
-    try:
-        bucket_name = "memes"
-        file_name = image_url.split("/")[-1]
-
-        minio_client.remove_object(bucket_name, file_name)
-
-    except S3Error as err:
-        raise HTTPException(status_code=500, detail=f"MinIO error: {err}")
-
-
-async def update_image_in_minio(file: UploadFile, image_url: str):
-    new_image_url = await upload_image_to_minio(file)
-    await delete_image_from_minio(image_url)
-
-    return new_image_url
+# presigning is done locally, the fixed region avoids a bucket location request
+presign_client = Minio(
+    MINIO_PUBLIC_ENDPOINT,
+    access_key=MINIO_ACCESS_KEY,
+    secret_key=MINIO_SECRET_KEY,
+    secure=MINIO_PUBLIC_SECURE,
+    region=MINIO_REGION,
+)
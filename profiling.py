@@ -0,0 +1,141 @@
+"""
+Per-request profile of the time spent in the database, the image store,
+authentication and password hashing.
+
+While enabled, every request gets a RequestProfile in a context variable;
+SQL statements are timed by the engine listeners of metrics, which add them
+here, and the other phases are added by the code that runs them. The totals
+are sent in a Server-Timing header and a warning listing the statements is
+logged for the requests over the thresholds. Disabled, the middleware passes
+requests straight through and no statement finds a profile to add to.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from config import PROFILING_ENABLED, PROFILING_MAX_QUERIES, PROFILING_SLOW_MS
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('db', 'storage', 'auth', 'hashing')
+
+enabled = False
+max_queries = PROFILING_MAX_QUERIES
+slow_ms = PROFILING_SLOW_MS
+
+
+class RequestProfile:
+    __slots__ = ('started', 'phases', 'queries')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        # (statement, seconds) in execution order
+        self.queries = []
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        # the phases overlap: the user lookup of the auth dependency is also counted in db
+        descriptions = {'db': f'{len(self.queries)} queries', 'auth': 'db lookup included'}
+        metrics = []
+        for name in PHASES:
+            metric = f'{name};dur={self.phases[name] * 1000:.1f}'
+            if name in descriptions:
+                metric += f';desc="{descriptions[name]}"'
+            metrics.append(metric)
+        metrics.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar('current_profile', default=None)
+
+
+def record_phase(name: str, seconds: float):
+    profile = current_profile.get()
+    if profile is not None:
+        profile.phases[name] += seconds
+
+
+@contextmanager
+def phase(name: str):
+    """Add the time spent in the block to a phase of the current request."""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.phases[name] += time.perf_counter() - started
+
+
+def record_query(statement: str, seconds: float):
+    """Add a SQL statement to the current request, called by the engine listeners of metrics."""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.phases['db'] += seconds
+        profile.queries.append((statement, seconds))
+
+
+def configure(enable: bool, query_limit: Optional[int]=None, duration_limit_ms: Optional[float]=None):
+    """Switch profiling at runtime, requests already running keep their profile."""
+    global enabled, max_queries, slow_ms
+    if query_limit is not None:
+        max_queries = query_limit
+    if duration_limit_ms is not None:
+        slow_ms = duration_limit_ms
+    enabled = enable
+
+
+def settings() -> dict:
+    return {'enabled': enabled, 'max_queries': max_queries, 'slow_ms': slow_ms}
+
+
+def _log_if_slow(scope, profile: RequestProfile):
+    elapsed_ms = profile.elapsed() * 1000
+    if len(profile.queries) <= max_queries and elapsed_ms <= slow_ms:
+        return
+    statements = '\n'.join(
+        f'  {index}. {seconds * 1000:.1f} ms {statement}' for index, (statement, seconds) in enumerate(profile.queries, 1)
+    )
+    logger.warning(
+        "Slow request %s %s: %.1f ms, %d queries (%s)\n%s",
+        scope['method'], scope['path'], elapsed_ms, len(profile.queries), profile.server_timing(), statements,
+    )
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware giving each request its profile while profiling is enabled."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not enabled or scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+
+        async def send_with_timing(message):
+            # a streamed body is still being read from the store when the headers
+            # go out, that part only shows in the logged total
+            if message['type'] == 'http.response.start':
+                headers = [*message.get('headers', ()), (b'server-timing', profile.server_timing().encode('latin-1'))]
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_profile.reset(token)
+            _log_if_slow(scope, profile)
+
+
+configure(PROFILING_ENABLED)
@@ -0,0 +1,178 @@
+"""
+Removes objects of the image store that no meme references anymore.
+
+A failure between the database write and the storage call leaks objects:
+an upload whose meme was never inserted, an image whose delete did not reach
+the store, a reference that was never released. The store is listed in
+batches and each batch is checked against the memes: the reference counts of
+image_objects are set back to the number of memes using each image and the
+orphans older than the grace period are deleted, so memory stays bounded
+whatever the size of the store.
+
+    python -m reconcile --grace-hours 24 --dry-run
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
+
+from sqlalchemy import Integer, String, column, delete, func, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import storage
+from config import RECONCILE_BATCH_SIZE, RECONCILE_GRACE_HOURS
+from database.db import async_session
+from database.models import ImageObject, Meme
+from storage import image_url_for, run_in_storage_pool
+
+logger = logging.getLogger(__name__)
+
+
+def base_object_name(object_name: str) -> Optional[str]:
+    """Name of the image the object belongs to, None for a staged upload."""
+    if object_name.startswith('uploads/'):
+        return None
+    if object_name.startswith('variants/'):
+        return object_name.split('/', 2)[-1]
+    return object_name
+
+
+def find_orphans(objects: Iterable, referenced: set, cutoff: datetime) -> list:
+    """
+    Names of the objects older than the cutoff whose image is not referenced.
+    Staged uploads are never referenced, they are promoted or discarded within a request.
+    """
+    orphans = []
+    for obj in objects:
+        if obj.last_modified is None or obj.last_modified >= cutoff:
+            continue
+        base = base_object_name(obj.name)
+        if base is None or base not in referenced:
+            orphans.append(obj.name)
+    return orphans
+
+
+async def count_memes(db: AsyncSession, names: set) -> dict:
+    """Number of memes using each of these images, the unused ones are left out."""
+    if not names:
+        return {}
+    urls = {image_url_for(name): name for name in names}
+    async with db.begin():
+        result = await db.execute(
+            select(Meme.image_url, func.count()).where(Meme.image_url.in_(urls)).group_by(Meme.image_url)
+        )
+    return {urls[image_url]: count for image_url, count in result.all()}
+
+
+async def recent_references(db: AsyncSession, names: set, cutoff: datetime) -> set:
+    """Images referenced since the cutoff, by an upload whose meme may not be inserted yet."""
+    if not names:
+        return set()
+    async with db.begin():
+        result = await db.execute(
+            select(ImageObject.key).where(ImageObject.key.in_(names), ImageObject.referenced_at >= cutoff)
+        )
+    return set(result.scalars().all())
+
+
+async def repair_ref_counts(db: AsyncSession, meme_counts: dict, cutoff: datetime) -> int:
+    """
+    Set the reference counts back to the number of memes, except for the images
+    referenced since the cutoff. Returns the number of rows changed.
+    """
+    if not meme_counts:
+        return 0
+    memes = values(column('key', String), column('count', Integer), name='memes').data(list(meme_counts.items()))
+    async with db.begin():
+        result = await db.execute(
+            update(ImageObject)
+            .where(ImageObject.key == memes.c.key, ImageObject.referenced_at < cutoff, ImageObject.ref_count != memes.c.count)
+            .values(ref_count=memes.c.count)
+            .returning(ImageObject.key)
+            .execution_options(synchronize_session=False)
+        )
+    repaired = result.scalars().all()
+    for key in repaired:
+        logger.info("Repaired the reference count of %s", key)
+    return len(repaired)
+
+
+async def delete_orphans(db: AsyncSession, orphans: list, unreferenced: set, cutoff: datetime) -> tuple:
+    """
+    Delete the orphan objects with the rows of their unreferenced images.
+    Returns the objects deleted and the errors of the store.
+    """
+    async with db.begin():
+        # a real transaction, as in release_images: the deleted rows stay locked until their
+        # objects are gone, so an upload of the same bytes waits and stores them again
+        await db.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+        await db.execute(
+            delete(ImageObject)
+            .where(ImageObject.key.in_(unreferenced), ImageObject.referenced_at < cutoff)
+            .execution_options(synchronize_session=False)
+        )
+        # the rows left were referenced by an upload meanwhile, their objects are kept
+        result = await db.execute(select(ImageObject.key).where(ImageObject.key.in_(unreferenced)))
+        kept = set(result.scalars().all())
+        orphans = [name for name in orphans if base_object_name(name) not in kept]
+        if not orphans:
+            return orphans, []
+        return orphans, await run_in_storage_pool(storage.backend.delete, orphans)
+
+
+def _next_batch(objects, batch_size: int) -> list:
+    return list(itertools.islice(objects, batch_size))
+
+
+async def reconcile(grace_hours: float=RECONCILE_GRACE_HOURS, batch_size: int=RECONCILE_BATCH_SIZE, dry_run: bool=False) -> dict:
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=grace_hours)
+    stats = {'scanned': 0, 'orphans': 0, 'deleted': 0, 'errors': 0, 'repaired': 0, 'dry_run': dry_run}
+
+    # the listing is lazy, each batch is fetched from the store only when needed
+    objects = storage.backend.list()
+
+    async with async_session() as db:
+        while True:
+            batch = await run_in_storage_pool(_next_batch, objects, batch_size)
+            if not batch:
+                break
+            stats['scanned'] += len(batch)
+
+            names = {base_object_name(obj.name) for obj in batch} - {None}
+            meme_counts = await count_memes(db, names)
+            referenced = set(meme_counts) | await recent_references(db, names - set(meme_counts), cutoff)
+            orphans = find_orphans(batch, referenced, cutoff)
+            stats['orphans'] += len(orphans)
+
+            if dry_run:
+                for name in orphans:
+                    logger.info("Orphan object %s", name)
+                continue
+
+            stats['repaired'] += await repair_ref_counts(db, meme_counts, cutoff)
+            if not orphans:
+                continue
+
+            orphans, errors = await delete_orphans(db, orphans, names - referenced, cutoff)
+            for err in errors:
+                logger.warning("Failed to delete an orphan: %s", err)
+            stats['errors'] += len(errors)
+            stats['deleted'] += len(orphans) - len(errors)
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grace-hours', type=float, default=RECONCILE_GRACE_HOURS,
+                        help='objects younger than this are kept, they may belong to a request in progress')
+    parser.add_argument('--batch-size', type=int, default=RECONCILE_BATCH_SIZE, help='objects listed and checked at once')
+    parser.add_argument('--dry-run', action='store_true', help='only report the orphans')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(asyncio.run(reconcile(args.grace_hours, args.batch_size, args.dry_run))))
@@ -0,0 +1,179 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from config import RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_URL
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCacheBackend:
+    """
+    In-process LRU of serialized responses, limited by the total size of the values.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._data = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        self._remove(key)
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._data.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def _remove(self, key: str):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= len(item[0])
+
+
+class MemoryCacheBackend:
+    """
+    Shared backend kept in process memory.
+    Stands in for Redis in tests and single-worker deployments.
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float]=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires_at)
+
+    async def incr(self, key: str) -> int:
+        value = int(await self.get(key) or 0) + 1
+        self._data[key] = (str(value).encode(), None)
+        return value
+
+
+class RedisCacheBackend:
+    """
+    Shared backend on Redis, so every worker sees the same entries and invalidations.
+    """
+
+    def __init__(self, url: str):
+        try:
+            from redis import asyncio as redis
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_URL is set, but the redis package is not installed")
+        self._client = redis.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float]=None):
+        await self._client.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def incr(self, key: str) -> int:
+        return await self._client.incr(key)
+
+
+class ResponseCache:
+    """
+    Cache of pre-serialized responses, split in namespaces (one per table).
+
+    Keys carry the generation of their namespace, so invalidate() only has to
+    bump the generation: entries of older generations are never read again and
+    age out of the LRU. With a shared backend the generation lives there, and a
+    write in one worker invalidates the cache of all of them.
+    """
+
+    def __init__(self, local: LocalCacheBackend, shared=None):
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self._generations = {}
+
+    async def key(self, namespace: str, params: dict) -> str:
+        """Build the key before reading the data, so a concurrent write makes it stale."""
+        generation = self._generations.get(namespace, 0)
+        if self.shared is not None:
+            try:
+                generation = int(await self.shared.get(f'{namespace}:generation') or 0)
+            except Exception as err:
+                logger.warning("Response cache backend is unavailable: %s", err)
+
+        normalized = '&'.join(f'{name}={params[name]}' for name in sorted(params))
+        return f'{namespace}:{generation}:{normalized}'
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            try:
+                value = await self.shared.get(key)
+            except Exception as err:
+                logger.warning("Response cache backend is unavailable: %s", err)
+            if value is not None:
+                self.local.set(key, value)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes):
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                await self.shared.set(key, value, self.local.ttl)
+            except Exception as err:
+                logger.warning("Response cache backend is unavailable: %s", err)
+
+    async def invalidate(self, namespace: str):
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+        if self.shared is not None:
+            try:
+                await self.shared.incr(f'{namespace}:generation')
+            except Exception as err:
+                logger.warning("Response cache backend is unavailable: %s", err)
+
+
+def pack_response(headers: dict, body: bytes) -> bytes:
+    return json.dumps(headers).encode() + b'\n' + body
+
+
+def unpack_response(value: bytes) -> Tuple[dict, bytes]:
+    headers, body = value.split(b'\n', 1)
+    return json.loads(headers), body
+
+
+response_cache = ResponseCache(
+    LocalCacheBackend(max_bytes=RESPONSE_CACHE_BYTES, ttl=RESPONSE_CACHE_TTL),
+    shared=RedisCacheBackend(RESPONSE_CACHE_URL) if RESPONSE_CACHE_URL else None,
+)
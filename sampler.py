@@ -0,0 +1,91 @@
+"""
+Sampling profiler for a running worker, taken on demand through /admin/profile.
+
+A background thread reads the stacks of all threads with sys._current_frames
+at a fixed rate. Each stack is added to a trie of frames, so a long session
+costs one node per distinct call path and not one entry per sample. The
+result is in the collapsed format read by flamegraph.pl, speedscope and
+similar tools: one line per stack, frames from the root separated by ';',
+followed by the number of samples.
+"""
+import sys
+import threading
+import time
+from typing import Dict
+
+
+class _Node:
+    __slots__ = ('children', 'count')
+
+    def __init__(self):
+        self.children: Dict[str, _Node] = {}
+        # samples whose stack ends at this frame
+        self.count = 0
+
+
+class StackTrie:
+    def __init__(self):
+        self.root = _Node()
+        self.samples = 0
+        # one label per code object, shared by every node of that function
+        self._labels = {}
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+        return label
+
+    def add(self, thread_name: str, frame):
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+
+        node = self.root.children.get(thread_name)
+        if node is None:
+            node = self.root.children[thread_name] = _Node()
+        for code in reversed(codes):
+            label = self._label(code)
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _Node()
+            node = child
+        node.count += 1
+
+    def collapsed(self) -> str:
+        lines = []
+        # iterative, the stacks of a deep recursion would exceed the recursion limit
+        stack = [(child, name) for name, child in self.root.children.items()]
+        while stack:
+            node, path = stack.pop()
+            if node.count:
+                lines.append(f'{path} {node.count}')
+            stack.extend((child, f'{path};{label}') for label, child in node.children.items())
+        lines.sort()
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+def sample_stacks(seconds: float, rate: float) -> StackTrie:
+    """Sample every thread but the calling one for the given time, blocking."""
+    trie = StackTrie()
+    own_ident = threading.get_ident()
+    interval = 1 / rate
+    deadline = time.monotonic() + seconds
+    next_sample = time.monotonic()
+
+    while next_sample < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != own_ident:
+                trie.add(names.get(ident, f'thread-{ident}'), frame)
+        trie.samples += 1
+
+        # a fixed schedule, a slow sample does not shift the following ones
+        next_sample += interval
+        delay = next_sample - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_sample = time.monotonic()
+    return trie
@@ -0,0 +1,489 @@
+import asyncio
+import functools
+import hashlib
+import hmac
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional
+from urllib.parse import quote, urlencode
+
+from fastapi import HTTPException, UploadFile
+from minio.commonconfig import CopySource
+from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
+
+from config import (IMAGE_CHUNK_SIZE, IMAGE_VARIANTS, MINIO_POOL_SIZE,
+                    PRESIGNED_URL_EXPIRES, PRESIGNED_URL_MARGIN,
+                    STORAGE_BACKEND, STORAGE_PATH, STORAGE_PUBLIC_URL,
+                    STORAGE_URL_SECRET)
+from metrics import storage_operation_duration
+from profiling import record_phase
+from utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = 'memes'
+
+
+class StorageError(Exception):
+    """Failure of the object store, reported to clients as a 500."""
+
+
+class ObjectInfo(NamedTuple):
+    name: str
+    size: int
+    etag: str
+    last_modified: datetime
+    content_type: Optional[str] = None
+
+
+class StorageBackend(ABC):
+    """
+    Object store holding the images. Calls are blocking and go through
+    the storage pool, errors are raised as StorageError.
+    """
+
+    @abstractmethod
+    def put(self, name: str, reader: BinaryIO, content_type: str, length: int=-1):
+        """Store everything read from the reader under this name."""
+
+    @abstractmethod
+    def copy(self, source: str, name: str):
+        """Store a copy of the source object under this name."""
+
+    @abstractmethod
+    def open(self, name: str, offset: int=0, length: int=0):
+        """Reader over the object body from offset, length 0 means up to the end."""
+
+    @abstractmethod
+    def stat(self, name: str) -> Optional[ObjectInfo]:
+        """Object info, None when there is no such object."""
+
+    @abstractmethod
+    def delete(self, names: List[str]) -> List[str]:
+        """Delete the objects, missing ones included. Returns the error messages."""
+
+    @abstractmethod
+    def list(self) -> Iterator[ObjectInfo]:
+        """Every object, lazily."""
+
+    @abstractmethod
+    def presign(self, name: str, expires: int) -> str:
+        """URL downloading the object without credentials for expires seconds."""
+
+    def local_path(self, name: str) -> Optional[str]:
+        """Path of the object on local disk, for zero-copy responses. None if not local."""
+        return None
+
+
+class MinioStorage(StorageBackend):
+    # S3 accepts at most 1000 keys per multi-object delete
+    DELETE_BATCH_SIZE = 1000
+
+    def __init__(self, client, presign_client, bucket_name: str=BUCKET_NAME):
+        self.client = client
+        self.presign_client = presign_client
+        self.bucket_name = bucket_name
+        self._bucket_checked = False
+
+    @staticmethod
+    def _error(err) -> StorageError:
+        return StorageError(f"MinIO error: {err}")
+
+    def _ensure_bucket(self):
+        # checked once per process instead of once per upload
+        if self._bucket_checked:
+            return
+        if not self.client.bucket_exists(self.bucket_name):
+            self.client.make_bucket(self.bucket_name)
+        self._bucket_checked = True
+
+    def put(self, name: str, reader: BinaryIO, content_type: str, length: int=-1):
+        try:
+            self._ensure_bucket()
+            self.client.put_object(self.bucket_name, name, reader, length=length, part_size=10*1024*1024,
+                                   content_type=content_type)
+        except S3Error as err:
+            raise self._error(err)
+
+    def copy(self, source: str, name: str):
+        try:
+            # server-side copy, the bytes do not go through the app again
+            self.client.copy_object(self.bucket_name, name, CopySource(self.bucket_name, source))
+        except S3Error as err:
+            raise self._error(err)
+
+    def open(self, name: str, offset: int=0, length: int=0):
+        try:
+            return _MinioReader(self.client.get_object(self.bucket_name, name, offset=offset, length=length))
+        except S3Error as err:
+            raise self._error(err)
+
+    def stat(self, name: str) -> Optional[ObjectInfo]:
+        try:
+            obj = self.client.stat_object(self.bucket_name, name)
+        except S3Error as err:
+            if err.code == 'NoSuchKey':
+                return None
+            raise self._error(err)
+        return ObjectInfo(name, obj.size, obj.etag, obj.last_modified, obj.content_type)
+
+    def delete(self, names: List[str]) -> List[str]:
+        errors = []
+        try:
+            for start in range(0, len(names), self.DELETE_BATCH_SIZE):
+                batch = [DeleteObject(name) for name in names[start:start + self.DELETE_BATCH_SIZE]]
+                # remove_objects is lazy, the request is only sent while iterating the errors
+                for err in self.client.remove_objects(self.bucket_name, batch):
+                    errors.append(f"MinIO error: {err.code}: {err.message} ({err.name})")
+        except S3Error as err:
+            raise self._error(err)
+        return errors
+
+    def list(self) -> Iterator[ObjectInfo]:
+        for obj in self.client.list_objects(self.bucket_name, recursive=True):
+            yield ObjectInfo(obj.object_name, obj.size, obj.etag, obj.last_modified)
+
+    def presign(self, name: str, expires: int) -> str:
+        # signed locally, no request to MinIO
+        return self.presign_client.presigned_get_object(self.bucket_name, name, expires=timedelta(seconds=expires))
+
+
+class _MinioReader:
+    def __init__(self, response):
+        self._response = response
+
+    def read(self, size: int=-1) -> bytes:
+        return self._response.read(size if size >= 0 else None)
+
+    def close(self):
+        self._response.close()
+        self._response.release_conn()
+
+
+# magic numbers of the image formats accepted on upload
+_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+
+def _sniff_content_type(head: bytes) -> Optional[str]:
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+class FilesystemStorage(StorageBackend):
+    """
+    Objects kept as files under a local directory, for single-node deployments.
+    Downloads are served straight from disk, presigned URLs are HMAC-signed
+    links to GET /storage/{name}.
+    """
+
+    def __init__(self, root: str, secret: str, public_url: str):
+        self.root = os.path.abspath(root)
+        self.secret = secret.encode()
+        self.public_url = public_url.rstrip('/')
+        # written files are moved into place, so readers never see partial objects
+        self._tmp_dir = os.path.join(self.root, '.tmp')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep) or path.startswith(self._tmp_dir + os.sep):
+            raise StorageError(f"Invalid object name: {name}")
+        return path
+
+    def _place(self, tmp_path: str, name: str):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    def put(self, name: str, reader: BinaryIO, content_type: str, length: int=-1):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+            with os.fdopen(fd, 'wb') as file:
+                shutil.copyfileobj(reader, file, IMAGE_CHUNK_SIZE)
+            self._place(tmp_path, name)
+        except OSError as err:
+            raise StorageError(f"Storage error: {err}")
+
+    def copy(self, source: str, name: str):
+        tmp_path = os.path.join(self._tmp_dir, uuid.uuid4().hex)
+        try:
+            try:
+                # a hard link shares the bytes instead of copying them
+                os.link(self._path(source), tmp_path)
+            except OSError:
+                shutil.copyfile(self._path(source), tmp_path)
+            self._place(tmp_path, name)
+        except OSError as err:
+            raise StorageError(f"Storage error: {err}")
+
+    def open(self, name: str, offset: int=0, length: int=0):
+        try:
+            file = open(self._path(name), 'rb')
+        except OSError as err:
+            raise StorageError(f"Storage error: {err}")
+        file.seek(offset)
+        return _RangeReader(file, length) if length else file
+
+    def stat(self, name: str) -> Optional[ObjectInfo]:
+        path = self._path(name)
+        try:
+            stat = os.stat(path)
+            with open(path, 'rb') as file:
+                head = file.read(12)
+        except FileNotFoundError:
+            return None
+        except OSError as err:
+            raise StorageError(f"Storage error: {err}")
+        return self._info(name, stat, _sniff_content_type(head))
+
+    @staticmethod
+    def _info(name: str, stat: os.stat_result, content_type: Optional[str]=None) -> ObjectInfo:
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        return ObjectInfo(name, stat.st_size, etag, last_modified, content_type)
+
+    def delete(self, names: List[str]) -> List[str]:
+        errors = []
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+            except (OSError, StorageError) as err:
+                errors.append(f"Storage error: {err}")
+        return errors
+
+    def list(self) -> Iterator[ObjectInfo]:
+        for directory, subdirectories, files in os.walk(self.root):
+            if directory == self.root:
+                subdirectories[:] = [name for name in subdirectories if name != '.tmp']
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                try:
+                    yield self._info(name, os.stat(path))
+                except FileNotFoundError:
+                    continue
+
+    def _signature(self, name: str, expires_at: int) -> str:
+        return hmac.new(self.secret, f"{name}\n{expires_at}".encode(), hashlib.sha256).hexdigest()
+
+    def presign(self, name: str, expires: int) -> str:
+        expires_at = int(time.time()) + expires
+        query = urlencode({'expires': expires_at, 'signature': self._signature(name, expires_at)})
+        return f"{self.public_url}/storage/{quote(name)}?{query}"
+
+    def verify(self, name: str, expires_at: int, signature: str) -> bool:
+        """Whether the link was signed by presign and has not expired yet."""
+        if expires_at < time.time():
+            return False
+        return hmac.compare_digest(self._signature(name, expires_at), signature)
+
+    def local_path(self, name: str) -> Optional[str]:
+        return self._path(name)
+
+
+class _RangeReader:
+    def __init__(self, file: BinaryIO, length: int):
+        self._file = file
+        self._remaining = length
+
+    def read(self, size: int=-1) -> bytes:
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def create_backend(name: str) -> StorageBackend:
+    if name == 'filesystem':
+        if not STORAGE_URL_SECRET:
+            raise ValueError("STORAGE_URL_SECRET is required with the filesystem storage backend")
+        return FilesystemStorage(STORAGE_PATH, STORAGE_URL_SECRET, STORAGE_PUBLIC_URL)
+    if name == 'minio':
+        from minio_server import minio_client, presign_client
+        return MinioStorage(minio_client, presign_client)
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+# replaced as a whole to switch stores, e.g. in benchmarks
+backend: StorageBackend = create_backend(STORAGE_BACKEND)
+
+presigned_url_cache = TTLCache(maxsize=10000, ttl=PRESIGNED_URL_EXPIRES - PRESIGNED_URL_MARGIN)
+
+# the store clients are blocking, so every call goes through this bounded pool
+storage_executor = ThreadPoolExecutor(max_workers=MINIO_POOL_SIZE, thread_name_prefix='storage')
+
+
+async def run_in_storage_pool(func, *args, **kwargs):
+    """Run a blocking storage call without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(storage_executor, functools.partial(func, *args, **kwargs))
+    finally:
+        elapsed = time.perf_counter() - started
+        storage_operation_duration.labels(func.__name__).observe(elapsed)
+        record_phase('storage', elapsed)
+
+
+def image_object_name(image_url: str, variant: Optional[str]=None) -> str:
+    """Object name of the image, resized variants are kept beside it under variants/."""
+    file_name = image_url.split('/')[-1]
+    if variant:
+        return f"variants/{variant}/{file_name}"
+    return file_name
+
+
+def image_url_for(object_name: str) -> str:
+    return f"http://127.0.0.1:9001/memes/{object_name}"
+
+
+class StagedImage(NamedTuple):
+    """Upload stored under a temporary name, waiting to be stored under its content hash."""
+    temp_name: str
+    digest: str
+    size: int
+
+
+class HashingReader:
+    """File wrapper computing the SHA-256 and size of everything read through it."""
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size: int=-1) -> bytes:
+        data = self._file.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+
+def _upload_image(file_name: str, file: UploadFile) -> StagedImage:
+    # the content is hashed while it streams to the store, in a single pass
+    reader = HashingReader(file.file)
+    backend.put(file_name, reader, file.content_type or 'application/octet-stream')
+    return StagedImage(file_name, reader.sha256.hexdigest(), reader.size)
+
+
+async def upload_image(file: UploadFile) -> StagedImage:
+    """
+    Upload the image under a temporary name. The caller then either promotes it
+    to its content-addressed name or discards it, when identical bytes are already stored.
+    """
+    try:
+        return await run_in_storage_pool(_upload_image, f"uploads/{uuid.uuid4()}", file)
+    except StorageError as err:
+        raise HTTPException(status_code=500, detail=str(err))
+
+
+def _promote_image(staged: StagedImage):
+    # the copy is skipped for content already stored, the result is the same object
+    if backend.stat(staged.digest) is None:
+        backend.copy(staged.temp_name, staged.digest)
+
+
+async def promote_image(staged: StagedImage) -> str:
+    """Store the upload under its content hash, keeping the staged object."""
+    try:
+        await run_in_storage_pool(_promote_image, staged)
+    except StorageError as err:
+        raise HTTPException(status_code=500, detail=str(err))
+
+    return image_url_for(staged.digest)
+
+
+async def discard_staged_images(staged_images: List[StagedImage]):
+    """
+    Delete the staged objects in one store call. A failure is only logged,
+    the leftovers are removed by the reconcile job.
+    """
+    try:
+        errors = await run_in_storage_pool(backend.delete, [staged.temp_name for staged in staged_images])
+    except StorageError as err:
+        errors = [str(err)]
+    for err in errors:
+        logger.warning("Failed to delete a staged upload: %s", err)
+
+
+async def stat_image(image_url: str, variant: Optional[str]=None) -> Optional[ObjectInfo]:
+    """Object info, or None for a variant that has not been generated (yet)."""
+    try:
+        info = await run_in_storage_pool(backend.stat, image_object_name(image_url, variant))
+    except StorageError as err:
+        raise HTTPException(status_code=500, detail=str(err))
+
+    if info is None and not variant:
+        raise HTTPException(status_code=500, detail=f"Image {image_object_name(image_url)} is missing from the storage.")
+    return info
+
+
+async def stream_image(image_url: str, offset: int=0, length: int=0, variant: Optional[str]=None):
+    """
+    Yield the object body chunk by chunk, so a download never holds
+    more than IMAGE_CHUNK_SIZE bytes of it in memory.
+    """
+    reader = await run_in_storage_pool(backend.open, image_object_name(image_url, variant), offset=offset, length=length)
+    try:
+        while True:
+            chunk = await run_in_storage_pool(reader.read, IMAGE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        reader.close()
+
+
+def image_file_path(image_url: str, variant: Optional[str]=None) -> Optional[str]:
+    """Local file of the image when the store keeps it on this machine."""
+    return backend.local_path(image_object_name(image_url, variant))
+
+
+def presigned_image_url(image_url: str, variant: Optional[str]=None) -> str:
+    """Short-lived download URL, reused until shortly before it expires."""
+    object_name = image_object_name(image_url, variant)
+    url = presigned_url_cache.get(object_name)
+    if url is None:
+        url = backend.presign(object_name, PRESIGNED_URL_EXPIRES)
+        presigned_url_cache.set(object_name, url)
+    return url
+
+
+async def delete_images(image_urls: list):
+    """Delete the images with their variants, in as few store calls as possible."""
+    object_names = [image_object_name(image_url, variant) for image_url in image_urls for variant in (None, *IMAGE_VARIANTS)]
+
+    try:
+        errors = await run_in_storage_pool(backend.delete, object_names)
+    except StorageError as err:
+        raise HTTPException(status_code=500, detail=str(err))
+
+    if errors:
+        raise HTTPException(status_code=500, detail=errors[0])
+
+
+async def delete_image(image_url: str):
+    await delete_images([image_url])
@@ -1,23 +1,48 @@
 import asyncio
+import hashlib
 import os
+import tempfile
+import threading
 import unittest
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
+from types import SimpleNamespace
 from typing import AsyncGenerator
 
 import aiofiles
 import asyncpg
-from fastapi import UploadFile
+from fastapi import HTTPException, UploadFile
 from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+from PIL import Image
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool
 from starlette.datastructures import Headers
 
-from config import (DB_TEST_HOST, DB_TEST_NAME, DB_TEST_PASS, DB_TEST_PORT,
-                    DB_TEST_USER)
+import metrics
+import profiling
+import storage
+from app.admin_api import admin_router
+from app.private_api.private_crud import update_meme_data
+from app.public_api.public_crud import (KEYSET_SORT_COLUMNS, list_memes_query,
+                                        user_cache)
+from config import (BCRYPT_ROUNDS, DB_TEST_HOST, DB_TEST_NAME, DB_TEST_PASS,
+                    DB_TEST_PORT, DB_TEST_USER)
 from database.db import Base, get_db
-from database.models import Meme, User
+from database.models import ImageObject, Meme, User
+from image_variants import _build_variants, nearest_variant
 from main import app
+from metrics import Histogram, render_metrics
+from reconcile import (count_memes, find_orphans, recent_references,
+                       repair_ref_counts)
+from response_cache import (LocalCacheBackend, MemoryCacheBackend,
+                            ResponseCache, response_cache)
+from sampler import sample_stacks
+from storage import FilesystemStorage, image_object_name, image_url_for
+from utils import Hasher, pack_cursor
 
 DATABASE_URL_TEST = f"postgresql+asyncpg://{DB_TEST_USER}:{DB_TEST_PASS}@{DB_TEST_HOST}:{DB_TEST_PORT}/{DB_TEST_NAME}"
 
@@ -44,11 +69,82 @@ async def init_db():
     async with engine_test.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
+async def explain(query) -> str:
+    """Plan of the query, with sequential scans discouraged as on a large table."""
+    sql = query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    async with async_session_maker() as db_session:
+        await db_session.execute(text("SET enable_seqscan = off"))
+        result = await db_session.execute(text(f"EXPLAIN {sql}"))
+        return "\n".join(result.scalars().all())
+
+async def add_user(email: str, hashed_password: str):
+    async with async_session_maker() as db_session:
+        async with db_session.begin():
+            db_session.add(User(name="test", surname="test", email=email, hashed_password=hashed_password))
+
+async def get_hashed_password(email: str) -> str:
+    async with async_session_maker() as db_session:
+        result = await db_session.execute(select(User.hashed_password).where(User.email == email))
+        return result.scalar_one()
+
+async def update_meme_concurrently(meme_id: int, image_paths: list):
+    """Run one update per image at once on the same meme, each in its own session."""
+    async with async_session_maker() as db_session:
+        meme = await db_session.get(Meme, meme_id)
+
+    async def update(image_path: str):
+        async with aiofiles.open(image_path, 'rb') as f:
+            file = UploadFile(filename=os.path.basename(image_path), file=BytesIO(await f.read()))
+        async with async_session_maker() as db_session:
+            return await update_meme_data(db_session, meme_id, meme.user_id, file=file)
+
+    return await asyncio.gather(*(update(image_path) for image_path in image_paths))
+
+async def get_image_references() -> tuple:
+    """Reference counts of the stored images next to the number of memes using each."""
+    async with async_session_maker() as db_session:
+        result = await db_session.execute(select(ImageObject.key, ImageObject.ref_count))
+        ref_counts = dict(result.all())
+        result = await db_session.execute(select(Meme.image_url))
+        meme_counts = {}
+        for image_url in result.scalars():
+            key = image_object_name(image_url)
+            meme_counts[key] = meme_counts.get(key, 0) + 1
+        return ref_counts, meme_counts
+
+async def reconcile_references(cutoff: datetime) -> tuple:
+    """Repair the counts of three images: used by a meme, unused, unused but referenced after the cutoff."""
+    async with async_session_maker() as db_session:
+        async with db_session.begin():
+            user = User(name="test", surname="test", email="reconcile@example.com", hashed_password="")
+            db_session.add(user)
+            await db_session.flush()
+            db_session.add(Meme(description="Test Meme", image_url=image_url_for('used'), user_id=user.id))
+            old = cutoff - timedelta(hours=1)
+            db_session.add_all([
+                ImageObject(key='used', size=1, ref_count=5, referenced_at=old),
+                ImageObject(key='stale', size=1, ref_count=2, referenced_at=old),
+                ImageObject(key='recent', size=1, ref_count=3),
+            ])
+
+        names = {'used', 'stale', 'recent'}
+        meme_counts = await count_memes(db_session, names)
+        referenced = set(meme_counts) | await recent_references(db_session, names - set(meme_counts), cutoff)
+        repaired = await repair_ref_counts(db_session, meme_counts, cutoff)
+
+        result = await db_session.execute(select(ImageObject.key, ImageObject.ref_count))
+        return referenced, repaired, dict(result.all())
+
 async def drop_db():
     async with engine_test.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
        
 
+class FailingDeleteStorage(FilesystemStorage):
+    def delete(self, names):
+        raise storage.StorageError("store unavailable")
+
+
 class TestBase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -60,6 +156,9 @@ class TestBase(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         asyncio.run(drop_db())
+        # users are recreated with new ids by the next test class
+        user_cache.clear()
+        asyncio.run(response_cache.invalidate(Meme.__tablename__))
        
 class TestUserRouter(TestBase):        
     def test_good_user(self):
@@ -110,6 +209,292 @@ class TestUserRouter(TestBase):
         )
         self.assertEqual(response.status_code, 401)
 
+    def test_login_rehashes_outdated_password(self):
+        outdated_rounds = 4 if BCRYPT_ROUNDS > 4 else 5
+        old_hash = CryptContext(schemes=['bcrypt'], bcrypt__rounds=outdated_rounds).hash("oldpassword")
+        asyncio.run(add_user("rehash@example.com", old_hash))
+
+        response = self.client.post(
+            "/user/token",
+            data={
+                "username": "rehash@example.com",
+                "password": "oldpassword"
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+
+        new_hash = asyncio.run(get_hashed_password("rehash@example.com"))
+        self.assertNotEqual(new_hash, old_hash)
+        self.assertTrue(new_hash.startswith(f"$2b${BCRYPT_ROUNDS:02d}$"))
+        self.assertTrue(Hasher.verify_password("oldpassword", new_hash))
+
+
+class TestReconcile(unittest.TestCase):
+    def test_find_orphans(self):
+        now = datetime.now(timezone.utc)
+        old, recent = now - timedelta(days=2), now - timedelta(minutes=5)
+        objects = [
+            SimpleNamespace(name='used', last_modified=old),
+            SimpleNamespace(name='variants/thumb/used', last_modified=old),
+            SimpleNamespace(name='gone', last_modified=old),
+            SimpleNamespace(name='variants/thumb/gone', last_modified=old),
+            SimpleNamespace(name='uploads/leftover', last_modified=old),
+            SimpleNamespace(name='fresh', last_modified=recent),
+            SimpleNamespace(name='uploads/in-progress', last_modified=recent),
+        ]
+
+        orphans = find_orphans(objects, {'used'}, now - timedelta(hours=24))
+
+        self.assertEqual(orphans, ['gone', 'variants/thumb/gone', 'uploads/leftover'])
+
+
+class TestReconcileReferences(TestBase):
+    def test_repair_ref_counts(self):
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=24)
+        referenced, repaired, ref_counts = asyncio.run(reconcile_references(cutoff))
+
+        # a row alone does not keep the object, the count follows the memes
+        self.assertEqual(referenced, {'used', 'recent'})
+        self.assertEqual(repaired, 1)
+        self.assertEqual(ref_counts, {'used': 1, 'stale': 2, 'recent': 3})
+
+
+class TestFilesystemStorage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = FilesystemStorage(self.directory.name, 'secret', 'http://testserver')
+        with open("tests/fixtures/test_image_3.png", "rb") as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_put_copy_delete(self):
+        self.storage.put('uploads/staged', BytesIO(self.content), 'image/png')
+        self.storage.copy('uploads/staged', 'digest')
+        self.assertEqual(self.storage.delete(['uploads/staged', 'missing']), [])
+
+        info = self.storage.stat('digest')
+        self.assertEqual((info.size, info.content_type), (len(self.content), 'image/png'))
+        self.assertIsNone(self.storage.stat('uploads/staged'))
+        self.assertEqual([info.name for info in self.storage.list()], ['digest'])
+
+        reader = self.storage.open('digest', offset=2, length=5)
+        self.assertEqual(reader.read(), self.content[2:7])
+        reader.close()
+
+    def test_invalid_name(self):
+        with self.assertRaises(storage.StorageError):
+            self.storage.stat('../outside')
+
+    def test_presigned_download(self):
+        self.storage.put('digest', BytesIO(self.content), 'image/png')
+        backend, storage.backend = storage.backend, self.storage
+        try:
+            client = TestClient(app)
+            url = self.storage.presign('digest', 60)
+
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, self.content)
+
+            response = client.get(url.replace('signature=', 'signature=0'))
+            self.assertEqual(response.status_code, 403)
+        finally:
+            storage.backend = backend
+
+
+class TestImageVariants(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend, storage.backend = storage.backend, FilesystemStorage(self.directory.name, 'secret', 'http://testserver')
+
+    def tearDown(self):
+        storage.backend = self.backend
+        self.directory.cleanup()
+
+    def variant_size(self, name: str):
+        reader = storage.backend.open(name)
+        try:
+            with Image.open(BytesIO(reader.read())) as image:
+                return image.size
+        finally:
+            reader.close()
+
+    def test_build_variants(self):
+        # 1024x703, bigger than both variants
+        with open("tests/fixtures/test_image_1.jpg", "rb") as f:
+            storage.backend.put('large', f, 'image/jpeg')
+        # 601x361, only bigger than the thumbnail
+        with open("tests/fixtures/test_image_3.png", "rb") as f:
+            storage.backend.put('small', f, 'image/png')
+
+        _build_variants(image_url_for('large'))
+        _build_variants(image_url_for('small'))
+
+        self.assertEqual(self.variant_size('variants/thumb/large'), (200, 137))
+        self.assertEqual(self.variant_size('variants/medium/large'), (800, 549))
+        self.assertEqual(self.variant_size('variants/thumb/small'), (200, 120))
+        # never upscaled, the original is served instead
+        self.assertIsNone(storage.backend.stat('variants/medium/small'))
+        self.assertEqual(storage.backend.stat('variants/thumb/large').content_type, 'image/jpeg')
+
+    def test_nearest_variant(self):
+        self.assertIsNone(nearest_variant(None))
+        self.assertIsNone(nearest_variant('original'))
+        self.assertEqual(nearest_variant('medium'), 'medium')
+        self.assertEqual(nearest_variant('150'), 'thumb')
+        self.assertEqual(nearest_variant('200'), 'thumb')
+        self.assertEqual(nearest_variant('201'), 'medium')
+        self.assertIsNone(nearest_variant('5000'))
+        with self.assertRaises(HTTPException):
+            nearest_variant('huge')
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.histogram = Histogram('test_duration_seconds', 'Test.', ('route',), buckets=(0.1, 1.0))
+
+    def tearDown(self):
+        metrics.registry.remove(self.histogram)
+
+    def test_histogram_buckets(self):
+        series = self.histogram.labels('/memes/{meme_id}')
+        self.assertIs(self.histogram.labels('/memes/{meme_id}'), series)
+        for value in (0.05, 0.1, 0.5, 5.0):
+            series.observe(value)
+
+        output = render_metrics()
+        self.assertIn('test_duration_seconds_bucket{route="/memes/{meme_id}",le="0.1"} 2', output)
+        self.assertIn('test_duration_seconds_bucket{route="/memes/{meme_id}",le="1.0"} 3', output)
+        self.assertIn('test_duration_seconds_bucket{route="/memes/{meme_id}",le="+Inf"} 4', output)
+        self.assertIn('test_duration_seconds_count{route="/memes/{meme_id}"} 4', output)
+
+    def test_route_template_label(self):
+        client = TestClient(app)
+        client.get('/storage/a/b', params={'expires': 0, 'signature': ''})
+
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_responses_total{method="GET",route="/storage/{name:path}",status="404"}', response.text)
+        self.assertIn('db_pool_connections{state="size"}', response.text)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.admin_token, admin_router.ADMIN_TOKEN = admin_router.ADMIN_TOKEN, 'admin'
+        self.client = TestClient(app)
+
+    def tearDown(self):
+        admin_router.ADMIN_TOKEN = self.admin_token
+        profiling.configure(False, profiling.PROFILING_MAX_QUERIES, profiling.PROFILING_SLOW_MS)
+
+    def test_switch_at_runtime(self):
+        response = self.client.put('/admin/profiling', params={'enabled': True}, headers={'X-Admin-Token': 'wrong'})
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.put('/admin/profiling', params={'enabled': True}, headers={'X-Admin-Token': 'admin'})
+        self.assertEqual(response.json()['enabled'], True)
+        timing = self.client.get('/metrics').headers['server-timing']
+        self.assertIn('db;dur=0.0;desc="0 queries"', timing)
+        self.assertIn('total;dur=', timing)
+
+        self.client.put('/admin/profiling', params={'enabled': False}, headers={'X-Admin-Token': 'admin'})
+        self.assertNotIn('server-timing', self.client.get('/metrics').headers)
+
+    def test_queries_counted_and_logged(self):
+        profiling.configure(True, query_limit=1)
+        engine = create_engine('sqlite://')
+        profile = profiling.RequestProfile()
+        token = profiling.current_profile.set(profile)
+        try:
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+                conn.execute(text('SELECT 2'))
+        finally:
+            profiling.current_profile.reset(token)
+
+        self.assertEqual([statement for statement, _ in profile.queries], ['SELECT 1', 'SELECT 2'])
+        with self.assertLogs('profiling', 'WARNING') as logs:
+            profiling._log_if_slow({'method': 'GET', 'path': '/memes/'}, profile)
+        self.assertIn('2 queries', logs.output[0])
+
+
+def busy_loop(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestSampler(unittest.TestCase):
+    def test_collapsed_stacks(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_loop, args=(stop,), name='busy')
+        worker.start()
+        try:
+            trie = sample_stacks(0.2, 200)
+        finally:
+            stop.set()
+            worker.join()
+
+        lines = [line for line in trie.collapsed().splitlines() if line.startswith('busy;')]
+        self.assertTrue(lines)
+        # one line per distinct stack, the samples of each summed at the end
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertIn(';busy_loop (', stack)
+        self.assertLessEqual(sum(int(line.rsplit(' ', 1)[1]) for line in lines), trie.samples)
+
+    def test_profile_endpoint(self):
+        admin_token, admin_router.ADMIN_TOKEN = admin_router.ADMIN_TOKEN, 'admin'
+        try:
+            client = TestClient(app)
+            response = client.get('/admin/profile', params={'seconds': 0.1, 'rate': 50}, headers={'X-Admin-Token': 'admin'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.headers['content-type'].startswith('text/plain'))
+            self.assertIn('MainThread;', response.text)
+
+            response = client.get('/admin/profile', params={'seconds': 3600}, headers={'X-Admin-Token': 'admin'})
+            self.assertEqual(response.status_code, 422)
+        finally:
+            admin_router.ADMIN_TOKEN = admin_token
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_invalidate_shared_generation(self):
+        shared = MemoryCacheBackend()
+        worker_1 = ResponseCache(LocalCacheBackend(max_bytes=1024, ttl=60), shared=shared)
+        worker_2 = ResponseCache(LocalCacheBackend(max_bytes=1024, ttl=60), shared=shared)
+
+        async def scenario():
+            key = await worker_1.key('memes', {'page': 0, 'size': 10})
+            await worker_1.set(key, b'[]')
+            self.assertEqual(await worker_2.get(await worker_2.key('memes', {'size': 10, 'page': 0})), b'[]')
+
+            await worker_2.invalidate('memes')
+            self.assertIsNone(await worker_1.get(await worker_1.key('memes', {'page': 0, 'size': 10})))
+
+        asyncio.run(scenario())
+
+    def test_local_byte_budget(self):
+        local = LocalCacheBackend(max_bytes=10, ttl=60)
+        local.set('a', b'12345')
+        local.set('b', b'12345')
+        local.set('c', b'12345')
+
+        self.assertIsNone(local.get('a'))
+        self.assertEqual(local.get('c'), b'12345')
+        self.assertEqual(local.size, 10)
+
+
+class TestHealthRouter(TestBase):
+
+    def test_db_pool_status(self):
+        response = self.client.get("/health/db")
+
+        self.assertEqual(response.status_code, 200)
+        for key in ('pool_size', 'checked_out', 'idle', 'overflow', 'max_overflow'):
+            self.assertIn(key, response.json())
+
 
 class TestMemePublicRouterNotMemes(TestBase):
 
@@ -139,6 +524,12 @@ class TestMemePublicRouter(TestBase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(len(response.json()) == 2)    
 
+    def test_get_memes_total_count(self):
+        response = self.client.get("/memes/?page=0&size=2")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('X-Total-Count'), '3')
+
     def test_get_memes_with_sorting(self):
         response = self.client.get("/memes/?sort_by=id&sort_desc=true")
 
@@ -152,6 +543,11 @@ class TestMemePublicRouter(TestBase):
         self.assertEqual(response.status_code, 422)
         self.assertIn("detail", response.json())   
 
+    def test_get_memes_with_page_out_of_range(self):
+        response = self.client.get(f"/memes/?page={2**63}")
+
+        self.assertEqual(response.status_code, 422)
+
     def test_get_memes_empty_result(self):
 
         response = self.client.get("/memes/?page=10&size=10")
@@ -159,6 +555,108 @@ class TestMemePublicRouter(TestBase):
         self.assertEqual(response.status_code, 404)
         self.assertIn("detail", response.json())
         self.assertEqual(response.json()["detail"], "No memes found")
+
+    def test_get_memes_with_cursor(self):
+        response = self.client.get("/memes/?size=2&sort_by=created_at")
+
+        self.assertEqual(response.status_code, 200)
+        first_page = [meme['id'] for meme in response.json()]
+        cursor = response.headers.get('X-Next-Cursor')
+        self.assertIsNotNone(cursor)
+
+        response = self.client.get(f"/memes/?size=2&sort_by=created_at&cursor={cursor}")
+
+        self.assertEqual(response.status_code, 200)
+        second_page = [meme['id'] for meme in response.json()]
+        self.assertEqual(len(second_page), 1)
+        self.assertFalse(set(first_page) & set(second_page))
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_get_memes_not_modified(self):
+        response = self.client.get("/memes/")
+
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+
+        response = self.client.get("/memes/", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers.get('ETag'), etag)
+
+    def test_get_memes_etag_is_per_page(self):
+        etag = self.client.get("/memes/").headers.get('ETag')
+
+        response = self.client.get("/memes/?page=1000", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get("/memes/?cursor=not-a-cursor", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_memes_cached(self):
+        self.client.get("/memes/?size=1")
+        hits = response_cache.hits
+
+        response = self.client.get("/memes/?size=1")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(response_cache.hits, hits + 1)
+
+    def test_get_memes_with_invalid_cursor(self):
+        response = self.client.get("/memes/?cursor=not-a-cursor")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["detail"], "Invalid cursor")
+
+    def test_get_memes_with_cursor_out_of_range(self):
+        # ids are int4, a bigger key must not reach the database
+        for key in (2**31, 2**63, 1e400):
+            cursor = pack_cursor({"s": "id", "d": False, "k": [key]})
+            response = self.client.get(f"/memes/?cursor={cursor}")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["detail"], "Invalid cursor")
+
+        cursor = pack_cursor({"s": "rank", "q": "Test", "k": [0.1, 2**63]})
+        response = self.client.get(f"/memes/search?q=Test&cursor={cursor}")
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_memes_with_unknown_sort_key(self):
+        response = self.client.get("/memes/?sort_by=description")
+
+        self.assertEqual(response.status_code, 422)
+
+    def test_get_memes_sorts_use_index(self):
+        indexes = {'id': 'memes_pkey', 'created_at': 'ix_memes_created_at_id'}
+        self.assertEqual(set(indexes), set(KEYSET_SORT_COLUMNS))
+        for sort_by, index in indexes.items():
+            for sort_desc in (False, True):
+                plan = asyncio.run(explain(list_memes_query(0, 10, sort_by, sort_desc)))
+                message = f"sort_by={sort_by} sort_desc={sort_desc}:\n{plan}"
+                # the rows come in index order: a bitmap scan would need a Sort on top
+                self.assertIn(f"Index Scan Backward using {index}" if sort_desc else f"Index Scan using {index}", plan, message)
+                self.assertNotIn("Sort", plan, message)
+
+    def test_search_memes(self):
+        response = self.client.get("/memes/search?q=meme&size=2")
+
+        self.assertEqual(response.status_code, 200)
+        first_page = [meme['id'] for meme in response.json()]
+        self.assertEqual(len(first_page), 2)
+        cursor = response.headers.get('X-Next-Cursor')
+
+        response = self.client.get(f"/memes/search?q=meme&size=2&cursor={cursor}")
+
+        self.assertEqual(response.status_code, 200)
+        second_page = [meme['id'] for meme in response.json()]
+        self.assertEqual(len(second_page), 1)
+        self.assertFalse(set(first_page) & set(second_page))
+
+    def test_search_memes_no_match(self):
+        response = self.client.get("/memes/search?q=nothing")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "No memes found")
     
 
 class TestBaseForPrivateRouter(TestBase):
@@ -255,6 +753,79 @@ class TestMemePrivateRouterUpload(TestBaseForPrivateRouter):
         self.assertEqual(response.status_code, 500)
         self.assertIn("Failed to upload image: 400: Uploaded file is not an image", response.json()["detail"])
 
+    def test_upload_memes_batch(self):
+        with open("tests/fixtures/test_image_2.jpeg", "rb") as f:
+            image_content = f.read()
+
+        files = [
+            ("files", ("first.jpg", BytesIO(image_content), "image/jpeg")),
+            ("files", ("test.txt", BytesIO(b"not an image"), "text/plain")),
+            ("files", ("second.jpg", BytesIO(image_content), "image/jpeg")),
+        ]
+        data = {"descriptions": ["first", "second", "third"]}
+
+        response = self.client.post("/memes/batch", files=files, data=data, headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["status"], "partial")
+        self.assertEqual([item["status"] for item in body["items"]], ["ok", "error", "ok"])
+        self.assertIn("Uploaded file is not an image", body["items"][1]["detail"])
+
+        first, second = body["items"][0]["id"], body["items"][2]["id"]
+        response = self.client.get(f"/memes/{second}", headers=self.headers)
+        self.assertEqual(response.json()["description"], "third")
+
+        # identical bytes are stored once
+        response = self.client.get(f"/memes/{first}", headers=self.headers)
+        self.assertEqual(response.json()["image_url"], self.client.get(f"/memes/{second}", headers=self.headers).json()["image_url"])
+
+
+class TestMemePrivateRouterMine(TestBaseForPrivateRouter):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        with open("tests/fixtures/test_image_1.jpg", "rb") as f:
+            file_content = f.read()
+        for description in ("first", "second", "third"):
+            files = {"file": ("test_image.jpg", BytesIO(file_content), "image/jpeg"),}
+            cls.client.post("/memes/", files=files, params={"description": description}, headers=cls.headers)
+
+    def test_get_my_memes(self):
+        response = self.client.get("/memes/mine?size=2", headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        first_page = response.json()
+        self.assertEqual(len(first_page), 2)
+        self.assertGreaterEqual(first_page[0]["created_at"], first_page[1]["created_at"])
+        cursor = response.headers.get('X-Next-Cursor')
+
+        response = self.client.get(f"/memes/mine?size=2&cursor={cursor}", headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        second_page = [meme["id"] for meme in response.json()]
+        self.assertTrue(second_page)
+        self.assertFalse({meme["id"] for meme in first_page} & set(second_page))
+
+    def test_get_my_memes_other_user(self):
+        response = self.client.get("/memes/mine", headers=self.headers_2)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "No memes found")
+
+    def test_get_my_memes_cursor_out_of_range(self):
+        cursor = pack_cursor({"s": "mine", "k": [datetime.now(timezone.utc).isoformat(), 2**63]})
+        response = self.client.get(f"/memes/mine?cursor={cursor}", headers=self.headers)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["detail"], "Invalid cursor")
+
+    def test_get_my_memes_unauthorized(self):
+        response = self.client.get("/memes/mine")
+
+        self.assertEqual(response.status_code, 401)
+
 
 class TestMemePrivateRouterUpdate(TestBaseForPrivateRouter):
 
@@ -282,6 +853,14 @@ class TestMemePrivateRouterUpdate(TestBaseForPrivateRouter):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {"status": "ok", "message": "Meme updated successfully"})
 
+    def test_update_meme_concurrent(self):
+        results = asyncio.run(update_meme_concurrently(1, ["tests/fixtures/test_image_1.jpg", "tests/fixtures/test_image_3.png"]))
+        self.assertEqual(results, [True, True])
+
+        # each previous image is released exactly once
+        ref_counts, meme_counts = asyncio.run(get_image_references())
+        self.assertEqual(ref_counts, meme_counts)
+
     def test_update_meme_not_meme(self):
 
         with open("tests/fixtures/test_image_1.jpg", "rb") as f:
@@ -359,12 +938,96 @@ class TestMemePrivateRouterGetMeme(TestBaseForPrivateRouter):
         self.assertEqual(response.json()['id'], 1)
         self.assertEqual(response.json()['description'], 'Meme description')
 
+    def test_get_meme_shared_image(self):
+        with open("tests/fixtures/test_image_2.jpeg", "rb") as f:
+            file_content = f.read()
+
+        files = {"file": ("test_image.jpg", BytesIO(file_content), "image/jpeg"),}
+        self.client.post("/memes/", files=files, params={'description': 'Same image'}, headers=self.headers)
+
+        first = self.client.get(f"/memes/{1}", headers=self.headers).json()
+        second = self.client.get(f"/memes/{2}", headers=self.headers).json()
+
+        self.assertEqual(first['image_url'], second['image_url'])
+        self.assertTrue(first['image_url'].endswith(hashlib.sha256(file_content).hexdigest()))
+
+    def test_get_meme_user_cache_hit(self):
+        self.client.get(f"/memes/{1}", headers=self.headers)
+        hits = user_cache.hits
+
+        response = self.client.get(f"/memes/{1}", headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user_cache.hits, hits + 1)
+
     def test_get_meme_no_author(self):
         response = self.client.get(f"/memes/{1}", headers=self.headers_2)
         
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.json()['detail'], "Only the author can access this meme.")
 
+    def test_get_meme_image_ok(self):
+        with open("tests/fixtures/test_image_2.jpeg", "rb") as f:
+            file_content = f.read()
+
+        response = self.client.get(f"/memes/image/{1}", headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['accept-ranges'], 'bytes')
+        self.assertEqual(response.content, file_content)
+
+    def test_get_meme_image_range(self):
+        with open("tests/fixtures/test_image_2.jpeg", "rb") as f:
+            file_content = f.read()
+
+        headers = Headers({"Authorization": f"Bearer {self.token}", "Range": "bytes=10-19"})
+        response = self.client.get(f"/memes/image/{1}", headers=headers)
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['content-range'], f"bytes 10-19/{len(file_content)}")
+        self.assertEqual(response.content, file_content[10:20])
+
+    def test_get_meme_image_variant(self):
+        # built here rather than waiting for the background task
+        image_url = self.client.get(f"/memes/{1}", headers=self.headers).json()["image_url"]
+        _build_variants(image_url)
+
+        response = self.client.get(f"/memes/image/{1}?size=thumb", headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('image/'))
+        # 700x820 scaled down to fit 200x200
+        with Image.open(BytesIO(response.content)) as image:
+            self.assertEqual(image.size, (171, 200))
+
+        response = self.client.get(f"/memes/image/{1}?size=thumb&delivery=redirect", headers=self.headers, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(image_object_name(image_url, 'thumb'), response.headers['location'])
+
+    def test_get_meme_image_unknown_size(self):
+        response = self.client.get(f"/memes/image/{1}?size=huge", headers=self.headers)
+
+        self.assertEqual(response.status_code, 422)
+
+    def test_get_meme_image_redirect(self):
+        response = self.client.get(f"/memes/image/{1}?delivery=redirect", headers=self.headers, follow_redirects=False)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("X-Amz-Signature", response.headers['location'])
+
+    def test_get_meme_image_range_not_satisfiable(self):
+        headers = Headers({"Authorization": f"Bearer {self.token}", "Range": "bytes=100000000-"})
+        response = self.client.get(f"/memes/image/{1}", headers=headers)
+
+        self.assertEqual(response.status_code, 416)
+
+    def test_get_meme_image_invalid_range_ignored(self):
+        headers = Headers({"Authorization": f"Bearer {self.token}", "Range": "bytes=5-3"})
+        response = self.client.get(f"/memes/image/{1}", headers=headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("content-range", response.headers)
+
 
 class TestMemePrivateRouterDeleteMeme(TestBaseForPrivateRouter):
 
@@ -397,6 +1060,46 @@ class TestMemePrivateRouterDeleteMeme(TestBaseForPrivateRouter):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.json()['detail'], "Only the author can delete this meme.")
 
+    def test_delete_memes_batch(self):
+        with open("tests/fixtures/test_image_1.jpg", "rb") as f:
+            files = [("files", ("test_image.jpg", BytesIO(f.read()), "image/jpeg"))]
+        response = self.client.post("/memes/batch", files=files, headers=self.headers)
+        meme_id = response.json()["items"][0]["id"]
+
+        response = self.client.post("/memes/batch-delete", json={"ids": [meme_id, 999999]}, headers=self.headers_2)
+        self.assertEqual(response.json()["status"], "error")
+        self.assertEqual([item["status"] for item in response.json()["items"]], ["forbidden", "not_found"])
+
+        response = self.client.post("/memes/batch-delete", json={"ids": [meme_id, 999999]}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "partial")
+        self.assertEqual(response.json()["items"][0], {"index": 0, "status": "deleted", "id": meme_id, "filename": None, "detail": None})
+
+        response = self.client.get(f"/memes/{meme_id}", headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_delete_memes_batch_release_failure(self):
+        with open("tests/fixtures/test_image_3.png", "rb") as f:
+            files = [("files", ("test_image.png", BytesIO(f.read()), "image/png"))]
+        response = self.client.post("/memes/batch", files=files, headers=self.headers)
+        meme_id = response.json()["items"][0]["id"]
+
+        with tempfile.TemporaryDirectory() as directory:
+            backend, storage.backend = storage.backend, FailingDeleteStorage(directory, 'secret', 'http://testserver')
+            try:
+                response = self.client.post("/memes/batch-delete", json={"ids": [meme_id, 999999]}, headers=self.headers)
+            finally:
+                storage.backend = backend
+
+        # the meme is gone, the image is left to the reconcile job
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item["status"] for item in response.json()["items"]], ["deleted", "not_found"])
+        self.assertIn("store unavailable", response.json()["items"][0]["detail"])
+
+    def test_delete_memes_batch_id_out_of_range(self):
+        response = self.client.post("/memes/batch-delete", json={"ids": [2**63]}, headers=self.headers)
+        self.assertEqual(response.status_code, 422)
+
 async def create_test_data_meme():
         async with async_session_maker() as db_session:
             user = User(name="test", surname='test', email='test@example.com', hashed_password="$2b$12$D/6ZRIonVLLgqU5HuVfMeOZG9N61HqeD8yKt/5aVS0YY.s.qts5KO")
@@ -1,9 +1,29 @@
+import asyncio
+import base64
+import json
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Hashable, Optional, Tuple
+
 from fastapi import HTTPException, UploadFile
 from passlib.context import CryptContext
-from sqlalchemy import select
+from sqlalchemy import Table, func, select, text
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.models import User
+from config import (BCRYPT_ROUNDS, HASHER_POOL_SIZE, TOTAL_COUNT_EXACT_LIMIT,
+                    TOTAL_COUNT_TTL)
+from database.models import TableVersion, User
+from profiling import phase
+
+try:
+    import orjson
+except ImportError:  # the standard library encoder is used instead, slower
+    orjson = None
 
 
 def validate_image(file: UploadFile):
@@ -14,6 +34,203 @@ def validate_image(file: UploadFile):
     return file
 
 
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        # same rendering as pydantic: UTC as Z
+        iso = value.isoformat()
+        return iso[:-6] + 'Z' if iso.endswith('+00:00') else iso
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_json(value: Any) -> bytes:
+    """JSON bytes of plain data (dicts, lists, str, int, datetime), without a model per item."""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_UTC_Z)
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def pack_cursor(payload: dict) -> str:
+    data = json.dumps(payload, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def unpack_cursor(cursor: str) -> dict:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if isinstance(payload, dict) and isinstance(payload.get('k'), list):
+            return payload
+    except (ValueError, TypeError):
+        pass
+    raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+# meme ids are int4, a larger key would overflow the query parameter
+INT4_MIN, INT4_MAX = -2**31, 2**31 - 1
+
+
+def cursor_int(value) -> int:
+    """Integer key of a cursor, ValueError when out of the int4 range."""
+    number = int(value)
+    if not INT4_MIN <= number <= INT4_MAX:
+        raise ValueError(f'Cursor key out of range: {number}')
+    return number
+
+
+def parse_range_header(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single byte range into inclusive (start, end) positions.
+    Returns None when the header should be ignored and the whole body served.
+    """
+    unit, _, byte_range = range_header.partition('=')
+    # multiple ranges are allowed to be answered with the full body
+    if unit.strip().lower() != 'bytes' or ',' in byte_range:
+        return None
+
+    start, separator, end = byte_range.strip().partition('-')
+    if not separator:
+        return None
+
+    try:
+        if start:
+            start = int(start)
+            if end and int(end) < start:
+                # last position before the first: an invalid range, ignored as RFC 9110 requires
+                return None
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            # suffix range: the last N bytes
+            start, end = max(size - int(end), 0), size - 1
+    except ValueError:
+        return None
+
+    if start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail='Requested range not satisfiable',
+            headers={'Content-Range': f'bytes */{size}'},
+        )
+    return start, end
+
+
+def if_range_matches(if_range: Optional[str], etag: str, last_modified: str) -> bool:
+    """A Range header only applies while the If-Range validator still matches."""
+    if if_range is None:
+        return True
+    return if_range.strip() in (etag, last_modified)
+
+
+def http_date(value: datetime) -> str:
+    return format_datetime(value, usegmt=True)
+
+
+def is_not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], etag: str, last_modified: Optional[datetime]) -> bool:
+    """Conditional GET check, If-None-Match takes precedence over If-Modified-Since."""
+    if if_none_match is not None:
+        # weak comparison, as recommended for If-None-Match
+        candidates = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in candidates or etag.removeprefix('W/') in candidates
+
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have a one second resolution
+        return since.tzinfo is not None and last_modified.replace(microsecond=0) <= since
+
+    return False
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries expire after ttl seconds.
+    Not thread-safe, meant to be used from the event loop only.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key: Hashable) -> Any:
+        item = self._data.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float]=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+async def get_table_version(db: AsyncSession, name: str) -> Tuple[int, Optional[datetime]]:
+    """Current write counter of the table and the time of the last write."""
+    result = await db.execute(
+        select(TableVersion.version, TableVersion.updated_at).where(TableVersion.name == name)
+    )
+    row = result.first()
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
+
+
+row_count_cache = TTLCache(maxsize=64, ttl=TOTAL_COUNT_TTL)
+
+
+async def count_rows(db: AsyncSession, table: Table, version: Optional[int]=None) -> int:
+    """
+    Number of rows of the table: exact while it is small, the planner's estimate
+    from pg_class above TOTAL_COUNT_EXACT_LIMIT, where COUNT(*) gets too slow.
+    Cached per table version, so a write is seen as soon as the version changes.
+    """
+    cache_key = (table.name, version)
+    count = row_count_cache.get(cache_key)
+    if count is not None:
+        return count
+
+    result = await db.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)"), {'name': table.name}
+    )
+    # -1 until the table is first analyzed
+    count = result.scalar() or -1
+    if count < TOTAL_COUNT_EXACT_LIMIT:
+        result = await db.execute(select(func.count()).select_from(table))
+        count = result.scalar()
+
+    row_count_cache.set(cache_key, count)
+    return count
+
+
+async def bump_table_version(db: AsyncSession, name: str):
+    """Call after the write, so readers never tag old rows with a new version."""
+    statement = insert(TableVersion).values(name=name, version=1).on_conflict_do_update(
+        index_elements=[TableVersion.name],
+        set_={'version': TableVersion.version + 1, 'updated_at': func.now()},
+    )
+    await db.execute(statement)
+
+
 class UserDAL:
     """Data Access Layer for operating user info"""
 
@@ -46,12 +263,41 @@ class UserDAL:
         else:
             return None
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+    async def update_password(self, user: User, hashed_password: str) -> User:
+        user.hashed_password = hashed_password
+        self.db_session.add(user)
+        await self.db_session.flush()
+        return user
+
+
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__rounds=BCRYPT_ROUNDS)
+
+_hash_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_hash_executor() -> ProcessPoolExecutor:
+    """Process pool for bcrypt, started on first use."""
+    global _hash_executor
+    if _hash_executor is None:
+        # spawn: forking a process that already runs threads and an event loop is unsafe
+        _hash_executor = ProcessPoolExecutor(
+            max_workers=HASHER_POOL_SIZE,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _hash_executor
+
+
+def shutdown_hash_executor():
+    global _hash_executor
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=False, cancel_futures=True)
+        _hash_executor = None
 
 
 class Hasher:
     """
     Password hashing and verification.
+    The *_async variants run bcrypt in the hashing process pool.
     """
     @staticmethod
     def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -60,3 +306,20 @@ class Hasher:
     @staticmethod
     def get_password_hash(password: str) -> str:
         return pwd_context.hash(password)
+
+    @staticmethod
+    def verify_and_update(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """Verify the password and return a new hash when the stored one uses outdated settings."""
+        return pwd_context.verify_and_update(plain_password, hashed_password)
+
+    @staticmethod
+    async def get_password_hash_async(password: str) -> str:
+        loop = asyncio.get_running_loop()
+        with phase('hashing'):
+            return await loop.run_in_executor(get_hash_executor(), Hasher.get_password_hash, password)
+
+    @staticmethod
+    async def verify_and_update_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        loop = asyncio.get_running_loop()
+        with phase('hashing'):
+            return await loop.run_in_executor(get_hash_executor(), Hasher.verify_and_update, plain_password, hashed_password)